@@ -43,6 +43,7 @@ class TestIt(vmtest.VmTestCase):
             assert x == 0xA6
             """)
 
+    @vmtest.py2_only
     def test_inplace_division(self):
         self.assert_ok("""\
             x, y = 24, 3
@@ -241,6 +242,42 @@ class TestIt(vmtest.VmTestCase):
             f()
             """, raises=NameError)
 
+    def test_rebinding_globals(self):
+        self.assert_ok("""\
+            def f():
+                return x, len([1, 2])
+            x = 1
+            print(f())
+            x = 2
+            print(f())
+            len = lambda l: 42
+            print(f())
+            del len
+            print(f())
+            """)
+        self.assert_ok("""\
+            from six.moves import builtins
+            old = abs
+            def f():
+                return abs(-1)
+            def g(new):
+                builtins.abs = new
+                return f()
+            print(f(), g(lambda x: 42), g(old))
+            """)
+        self.assert_ok("""\
+            def set_x(v):
+                global x
+                x = v
+            out = []
+            for i in range(3):
+                set_x(i)
+                out.append(x)
+            del x
+            print(out)
+            x
+            """, raises=NameError)
+
     def test_import(self):
         self.assert_ok("""\
             import math
@@ -429,7 +466,36 @@ class TestIt(vmtest.VmTestCase):
             assert b == 2
             assert c == 3
             """)
+        self.assert_ok("""\
+            def count():
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            a, b = iter([1, 2])
+            c, = "x"
+            print(a, b, c)
+            d, e = count()
+            """, raises=ValueError)
+        self.assert_ok("""\
+            a, b, c = [1, 2]
+            """, raises=ValueError)
+        self.assert_ok("""\
+            a, b = (1, 2, 3)
+            """, raises=ValueError)
+
+    def test_stack_shuffling(self):
+        self.assert_ok("""\
+            a, b, c = 1, 2, 3
+            a, b, c = c, a, b
+            a, b = b, a
+            x = [0, 1, 2]
+            x[a] += 10
+            x[0:2] += [5]
+            print(a, b, c, x, [a, b, c, a, b, c, a, b, c, a, b, c])
+            """)
 
+    @vmtest.py2_only
     def test_exec_statement(self):
         self.assert_ok("""\
             g = {}
@@ -498,6 +564,7 @@ class TestIt(vmtest.VmTestCase):
             """)
 
 # FAILED (errors=1)
+@vmtest.py2_only
 class TestPrinting(vmtest.VmTestCase):
     def test_printing(self):
         self.assert_ok("print 'hello'")
@@ -0,0 +1,52 @@
+from __future__ import print_function
+
+import vmtest
+import vmbatch
+
+
+class TestBatch(vmtest.VmTestCase):
+    def test_run_batch(self):
+        code = compile("print(x * 2)\n", "<double>", "exec")
+        jobs = [(code, {'x': i}) for i in range(6)]
+        jobs.append(("print(1)\n1 / 0\n", {}))
+        jobs.append(("def", {}))
+        results = list(vmbatch.run_batch(jobs, processes=2))
+        self.assertEqual(sorted(r['index'] for r in results), list(range(8)))
+        results.sort(key=lambda r: r['index'])
+        self.assertEqual([r['stdout'] for r in results[:6]],
+                         ["%d\n" % (i * 2) for i in range(6)])
+        self.assertTrue(all(r['exception'] is None for r in results[:6]))
+        self.assertTrue(all(r['time'] >= 0 for r in results))
+        self.assertEqual(results[6]['stdout'], "1\n")
+        self.assertIsInstance(results[6]['exception'], ZeroDivisionError)
+        self.assertIsInstance(results[7]['exception'], SyntaxError)
+
+    def test_run_job(self):
+        vm = vmbatch.VirtualMachine()
+        code = compile("print(name)\n", "<name>", "exec")
+        self.assertEqual(vmbatch.run_job(vm, code, {'name': 'a'}),
+                         (None, None, "a\n"))
+        value, exc, stdout = vmbatch.run_job(vm, code)
+        self.assertIsInstance(exc, NameError)
+        self.assertEqual(vmbatch.run_job(vm, code, {'name': 'b'})[2], "b\n")
+
+    def test_setup(self):
+        setup = ("table = dict((i, i * i) for i in range(10))\n"
+                 "def square(i):\n"
+                 "    return table[i]\n")
+        jobs = [("print(square(x))\ntable = None\n", {'x': i})
+                for i in range(4)]
+        results = sorted(vmbatch.run_batch(jobs, processes=2, setup=setup),
+                         key=lambda r: r['index'])
+        self.assertEqual([r['stdout'] for r in results],
+                         ["0\n", "1\n", "4\n", "9\n"])
+
+    def test_run_forked(self):
+        vm = vmbatch.VirtualMachine()
+        snapshot = vm.snapshot(compile("table = [1, 2]\n", "<setup>", "exec"))
+        code = compile("table.append(x)\nprint(table)\n", "<job>", "exec")
+        self.assertEqual(vmbatch.run_forked(snapshot, code, {'x': 3}),
+                         (None, None, "[1, 2, 3]\n"))
+        self.assertEqual(snapshot.f_globals['table'], [1, 2])
+        value, exc, stdout = vmbatch.run_forked(snapshot, code)
+        self.assertIsInstance(exc, NameError)
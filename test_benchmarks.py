@@ -0,0 +1,18 @@
+from __future__ import print_function
+import textwrap
+
+import vmtest
+import vmbench
+
+
+class TestBenchmarks(vmtest.VmTestCase):
+    def test_workloads(self):
+        for name, n, test_n, source in vmbench.BENCHMARKS:
+            self.assert_ok("N = %d\n" % test_n + textwrap.dedent(source))
+
+    def test_run_benchmark(self):
+        name, n, test_n, source = vmbench.BENCHMARKS[0]
+        result = vmbench.run_benchmark(name, test_n, source, repeat=1)
+        self.assertEqual(result['name'], 'fib')
+        self.assertGreater(result['instructions'], 0)
+        self.assertGreater(result['slowdown'], 0)
@@ -31,9 +31,11 @@ class TestExceptions(vmtest.VmTestCase):
     def test_raise_exception_class(self):
         self.assert_ok("raise ValueError", raises=ValueError)
 
+    @vmtest.py2_only
     def test_raise_exception_2args(self):
         self.assert_ok("raise ValueError, 'bad'", raises=ValueError)
 
+    @vmtest.py2_only
     def test_raise_exception_3args(self):
         self.assert_ok("""\
             from sys import exc_info
@@ -82,6 +84,28 @@ class TestExceptions(vmtest.VmTestCase):
             fn()
             """, raises=NameError)
 
+    def test_deleted_local_name_error(self):
+        self.assert_ok("""\
+            def fn():
+                x = 1
+                del x
+                return x
+            fn()
+            """, raises=UnboundLocalError)
+
+    def test_exception_in_loop(self):
+        self.assert_ok("""\
+            def fn(seq):
+                for i in seq:
+                    print(1 / i)
+                print("Shouldn't be here...")
+            try:
+                fn([1, 0, 2])
+            except ZeroDivisionError:
+                print("caught it!")
+            fn(None)
+            """, raises=TypeError)
+
     def test_catch_local_name_error(self):
         self.assert_ok("""\
             def fn():
@@ -91,6 +91,81 @@ class TestFunctions(vmtest.VmTestCase):
             fn()
             """)
 
+    def test_calling_functions_wrongly(self):
+        self.assert_ok("""\
+            def fn(a, b=17):
+                return a, b
+            fn(1, 2, 3)
+            """, raises=TypeError)
+        self.assert_ok("""\
+            def fn(a, b=17):
+                return a, b
+            fn(1, a=2)
+            """, raises=TypeError)
+        self.assert_ok("""\
+            def fn(a, b=17):
+                return a, b
+            fn(1, c=2)
+            """, raises=TypeError)
+        self.assert_ok("""\
+            def fn(a, b=17):
+                return a, b
+            fn(b=2)
+            """, raises=TypeError)
+
+    def test_method_calls(self):
+        self.assert_ok("""\
+            class A(object):
+                def m(self, x=0):
+                    return ('A', x)
+            class Logged(A):
+                def __getattribute__(self, name):
+                    print('get', name)
+                    return A.__getattribute__(self, name)
+            class Old:
+                def m(self, x):
+                    return ('Old', x)
+            a = A()
+            print(a.m(1), A.m(a, 2), Logged().m(3), Old().m(4))
+            a.m = lambda x: ('shadowed', x)
+            print(a.m(5), [1, 1].count(1))
+            print(A().m(A().m(6)[1] + 1))
+            """)
+
+    @vmtest.py2_only
+    def test_tuple_parameters(self):
+        self.assert_ok("""\
+            def fn(a, (b, c), d=4):
+                return a, b, c, d
+            print(fn(1, (2, 3)))
+            print(fn(1, [2, 3], d=5))
+            """)
+
+    def test_locals(self):
+        self.assert_ok("""\
+            def fn(a, b=17):
+                c = a + b
+                return sorted(locals().items())
+            print(fn(1))
+            """)
+
+    def test_function_attributes(self):
+        self.assert_ok("""\
+            def fn():
+                return fn.calls
+            fn.calls = 3
+            print(fn(), fn.__name__, fn.__dict__)
+            """)
+
+    def test_locals_outlive_call(self):
+        self.assert_ok("""\
+            def fn(a):
+                return locals()
+            x = fn(1)
+            y = fn(2)
+            print(x, y)
+            """)
+
     def test_partial(self):
         self.assert_ok("""\
             from _functools import partial
@@ -141,6 +216,35 @@ class TestClosures(vmtest.VmTestCase):
             assert a(7) == 28
             """)
 
+    def test_closures_see_rebinding(self):
+        self.assert_ok("""\
+            def outer():
+                x = 1
+                def get():
+                    return x
+                x = 2
+                first = get()
+                x = [3]
+                other = get
+                x.append(4)
+                return first, get(), other(), sorted(locals())
+            print(outer())
+            """)
+
+    def test_unbound_free_variable(self):
+        self.assert_ok("""\
+            def outer():
+                def get():
+                    return x
+                try:
+                    get()
+                except NameError as e:
+                    print(e)
+                x = 1
+                return get()
+            print(outer())
+            """)
+
     def test_closures_in_loop(self):
         self.assert_ok("""\
             def make_fns(x):
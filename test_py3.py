@@ -0,0 +1,163 @@
+from __future__ import print_function
+import vmtest
+
+
+@vmtest.py3_only
+class TestPy3(vmtest.VmTestCase):
+    def test_fstrings(self):
+        self.assert_ok("""\
+            x, name = 3.14159, "vm"
+            print(f"{name!r} {x:.2f} {x!s:>10} {name}{{}}")
+            """)
+
+    def test_keyword_only_arguments(self):
+        self.assert_ok("""\
+            def f(a, *args, b, c=3, **kw):
+                return a, args, b, c, kw
+            print(f(1, 2, b=4))
+            print(f(1, b=2, c=5, d=6))
+            """)
+        self.assert_ok("""\
+            def f(a, *, b):
+                return a + b
+            f(1)
+            """, raises=TypeError)
+
+    def test_call_unpacking(self):
+        self.assert_ok("""\
+            def f(*args, **kw):
+                return args, sorted(kw.items())
+            a, d = [1, 2], {'x': 3}
+            print(f(*a, 0, *a, y=4, **d))
+            print(f(**d, **{'z': 5}))
+            print([*a, *a], {*a}, {**d, 'w': 1})
+            """)
+        self.assert_ok("""\
+            def f(**kw):
+                return kw
+            f(**{'x': 1}, **{'x': 2})
+            """, raises=TypeError)
+
+    def test_star_unpacking(self):
+        self.assert_ok("""\
+            a, *b, c = range(6)
+            print(a, b, c)
+            *d, e = [1]
+            print(d, e)
+            """)
+        self.assert_ok("""\
+            a, *b, c = [1]
+            """, raises=ValueError)
+
+    def test_zero_argument_super(self):
+        self.assert_ok("""\
+            class A:
+                def hello(self):
+                    return "A"
+            class B(A):
+                def hello(self):
+                    return "B" + super().hello()
+                def cls(self):
+                    return __class__.__name__
+            print(B().hello(), B().cls())
+            """)
+
+    def test_methods(self):
+        self.assert_ok("""\
+            class C:
+                def m(self, x):
+                    return x * 2
+            c = C()
+            print(c.m(3), [].count(1))
+            c.m = lambda x: x + 1
+            print(c.m(3))
+            """)
+
+    def test_metaclass(self):
+        self.assert_ok("""\
+            class Meta(type):
+                def __new__(meta, name, bases, ns, **kw):
+                    ns['tag'] = kw.get('tag')
+                    return type.__new__(meta, name, bases, ns)
+            class C(metaclass=Meta, tag=7):
+                x: int = 1
+            print(type(C).__name__, C.tag, C.x, C.__annotations__)
+            """)
+
+    def test_yield_from(self):
+        self.assert_ok("""\
+            def inner():
+                got = yield 1
+                yield got
+                return 'done'
+            def outer():
+                result = yield from inner()
+                yield result
+            g = outer()
+            print(next(g), g.send('sent'), next(g))
+            print(list(outer()))
+            """)
+
+    def test_nonlocal(self):
+        self.assert_ok("""\
+            def counter():
+                n = 0
+                def inc():
+                    nonlocal n
+                    n += 1
+                    return n
+                return inc
+            c = counter()
+            c(); c()
+            print(c())
+            """)
+
+    def test_exception_handling(self):
+        self.assert_ok("""\
+            def f():
+                try:
+                    try:
+                        1 / 0
+                    except ZeroDivisionError:
+                        raise
+                except ArithmeticError as e:
+                    return type(e).__name__
+            print(f())
+            """)
+        self.assert_ok("""\
+            def f():
+                try:
+                    return 1
+                finally:
+                    print("finally")
+            print(f())
+            """)
+        self.assert_ok("""\
+            try:
+                raise ValueError("x") from KeyError("y")
+            except ValueError as e:
+                print(repr(e.__cause__))
+            """)
+        self.assert_ok("""\
+            raise
+            """, raises=RuntimeError)
+
+    def test_with_statement(self):
+        self.assert_ok("""\
+            class Quiet:
+                def __enter__(self):
+                    return "entered"
+                def __exit__(self, *exc):
+                    print("exit", exc[0].__name__ if exc[0] else None)
+                    return True
+            with Quiet() as q:
+                print(q)
+            with Quiet():
+                raise KeyError
+            def f():
+                for i in range(3):
+                    with Quiet():
+                        if i == 1:
+                            return i
+            print(f())
+            """)
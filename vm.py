@@ -3,6 +3,16 @@ import dis, inspect, types, operator
 import sys, re
 import logging
 import six
+import functools
+import itertools
+import json
+import timeit
+import weakref
+import hashlib
+import marshal
+import mmap
+import os
+import tempfile
 import collections
 
 CATCH = True 
@@ -14,91 +24,424 @@ logging.basicConfig(stream=sys.stderr, level=LOGGING_LEVEL, format='%(message)s'
 class VirtualMachineError(Exception):
     pass
 
+
+class BudgetExceeded(VirtualMachineError):
+    """A run used up its instruction budget or passed its deadline.
+
+    The frames it was running are dropped, and the VM is left ready for
+    another run.
+
+    """
+
+RecursionError = getattr(six.moves.builtins, 'RecursionError', RuntimeError)
+
+PY2 = six.PY2
+PY3 = six.PY3
+# Python 3.6+ bytecode is wordcode: every instruction is an opcode byte and
+# an argument byte.  The Python 3 handlers follow the 3.6/3.7 opcode set.
+WORDCODE = sys.version_info >= (3, 6)
+
+# why a bytecode stopped the straight-line run of its frame; handlers return
+# None to carry on with the next instruction
+WHY_RETURN = 1
+WHY_YIELD = 2
+WHY_BREAK = 3
+WHY_CONTINUE = 4
+WHY_EXCEPTION = 5
+WHY_RERAISE = 6
+WHY_CALL = 7
+# END_FINALLY after a `with` block whose __exit__ swallowed the exception
+WHY_SILENCED = 8
+# a counted run loop used up its instructions, see VirtualMachine._run_counted
+WHY_SUSPEND = 9
+# a guest call returned a host awaitable, see VirtualMachine.run_code_async
+WHY_AWAIT = 10
+
+CO_OPTIMIZED = inspect.CO_OPTIMIZED
+CO_VARARGS = inspect.CO_VARARGS
+CO_VARKEYWORDS = inspect.CO_VARKEYWORDS
+CO_GENERATOR = inspect.CO_GENERATOR
+
+# versions are unique across all VersionedDicts, so a version also
+# identifies the dict it was read from
+_next_version = functools.partial(next, itertools.count(1))
+
+class VersionedDict(dict):
+    """A dict that takes a new `version` whenever it is modified.
+
+    Used for guest globals so inline caches can be validated with a single
+    comparison.  Writes made by C code that bypasses the dict methods (such
+    as `exec`) must bump the version by calling `touch`.
+
+    `sites` holds the inline caches of the LOAD_GLOBAL/LOAD_NAME sites that
+    read this dict, keyed by site.  Keeping them here rather than in the
+    shared decoded stream means cached values live only as long as the
+    namespace they came from.
+
+    """
+    __slots__ = ('version', 'sites')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = _next_version()
+        self.sites = {}
+
+    def touch(self):
+        self.version = _next_version()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.version = _next_version()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version = _next_version()
+
+    def clear(self):
+        dict.clear(self)
+        self.version = _next_version()
+
+    def pop(self, *args):
+        self.version = _next_version()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.version = _next_version()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.version = _next_version()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version = _next_version()
+
+class FrameLayout(object):
+    """What a new frame for a code object needs, computed once per code
+    object: whether it uses fast locals, and where its cells come from.
+
+    """
+    __slots__ = ('optimized', 'cellvars', '__weakref__')
+
+    _layouts = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_code(cls, code):
+        try:
+            return cls._layouts[code]
+        except KeyError:
+            layout = cls._layouts[code] = cls(code)
+            return layout
+
+    def __init__(self, code):
+        self.optimized = bool(code.co_flags & CO_OPTIMIZED)
+        varnames = code.co_varnames
+        # for every cell variable, the index of the argument it starts out
+        # with, or None
+        self.cellvars = tuple(varnames.index(var) if var in varnames else None
+                              for var in code.co_cellvars)
+
+
 class Frame(object):
-    def __init__(self, f_code, f_globals, f_locals, f_back):
+    __slots__ = ('f_code', 'f_globals', '_f_locals', 'f_back', 'f_builtins',
+                 'fastlocals', 'stack', 'f_lasti', 'generator', 'block_stack',
+                 'cells', 'instrs', 'escaped')
+
+    def __init__(self, f_code, f_globals, f_locals, f_back, fastlocals=None,
+                 f_builtins=None, closure=None):
         self.f_code = f_code
         self.f_globals = f_globals
-        self.f_locals = f_locals
+        self._f_locals = f_locals
         self.f_back = f_back
-        if hasattr(__builtins__, '__dict__'):
-            self.f_builtins = __builtins__.__dict__ 
-        else:
-            self.f_builtins = __builtins__
+        if f_builtins is None:
+            f_builtins = vars(six.moves.builtins)
+        self.f_builtins = f_builtins
+        layout = FrameLayout.for_code(f_code)
+        # function frames keep their variables in a slot list indexed like
+        # co_varnames; unbound slots hold `nil`
+        if fastlocals is None and layout.optimized:
+            fastlocals = [f_locals.get(name, nil) for name in f_code.co_varnames]
+        self.fastlocals = fastlocals
         self.stack = []
-        self.last_instr = 0
-        self.running = True
-        
-        #refactor
         self.f_lasti = 0
         self.generator = None
         self.block_stack = []
+        # set once something outside the VM may hold on to the frame; such
+        # frames are never reused, see VirtualMachine.release_frame
+        self.escaped = False
+
+        # the frame's own cells followed by those of its closure, indexed
+        # like the argument of LOAD_DEREF and STORE_DEREF
+        cells = None
+        if layout.cellvars:
+            cells = [Cell(nil if index is None else fastlocals[index])
+                     for index in layout.cellvars]
+            if closure:
+                cells.extend(closure)
+        elif closure:
+            cells = list(closure)
+        self.cells = cells
+
+    @property
+    def f_locals(self):
+        """The frame's local namespace as a dict.
+
+        For function frames the dict is refreshed from the fast locals on
+        every access, so only LOAD_LOCALS, locals() and debuggers pay for it.
 
-        if f_code.co_cellvars:
-            self.cells = {}
-            for var in f_code.co_cellvars:
-                cell = self.f_locals.get(var)
-                self.cells[var] = cell
-        else:
-            self.cells = None
-
-        if f_code.co_freevars:
-            if not self.cells:
-                self.cells = {}
-            for var in f_code.co_freevars:
-                self.cells[var] = self.f_locals.get(var)
-        
+        """
+        self.escaped = True
+        f_locals = self._f_locals
+        if self.fastlocals is not None:
+            for name, val in zip(self.f_code.co_varnames, self.fastlocals):
+                if val is nil:
+                    f_locals.pop(name, None)
+                else:
+                    f_locals[name] = val
+        if self.cells is not None:
+            code = self.f_code
+            for name, cell in zip(code.co_cellvars + code.co_freevars,
+                                  self.cells):
+                if cell.cell_contents is nil:
+                    f_locals.pop(name, None)
+                else:
+                    f_locals[name] = cell.cell_contents
+        return f_locals
 
     def update_env(self, env):
         self.f_locals.update(env)
+        if self.fastlocals is not None:
+            for i, name in enumerate(self.f_code.co_varnames):
+                if name in env:
+                    self.fastlocals[i] = env[name]
+
+class Block(object):
+    __slots__ = ('type', 'handler', 'level')
+
+    def __init__(self, type, handler, level):
+        self.type = type
+        self.handler = handler
+        self.level = level
+
+    def __repr__(self):
+        return 'Block(%r, %r, %r)' % (self.type, self.handler, self.level)
+
+class Cell(object):
+    """A variable shared between a frame and the functions closing over
+    it.  Holds `nil` while unbound.
 
-Block = collections.namedtuple("Block", "type, handler, level")
+    """
+    __slots__ = ('cell_contents',)
+
+    def __init__(self, value):
+        self.cell_contents = value
+
+    def __repr__(self):
+        if self.cell_contents is nil:
+            return '<Cell: empty>'
+        return '<Cell: %r>' % (self.cell_contents,)
 
 def make_cell(value):
+    """A host cell object holding `value`."""
     fn = (lambda x: lambda: x)(value)
-    return fn.func_closure[0]
+    return six.get_function_closure(fn)[0]
+
+class ArgPlan(object):
+    """How to bind call arguments to the fast locals of a code object.
+
+    Computed once per code object.  `bind` handles positional and keyword
+    calls; it returns None for calls it cannot bind (missing, duplicate or
+    unexpected arguments) so the caller can fall back to
+    `inspect.getcallargs` for the error.
+
+    """
+    _plans = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_code(cls, code):
+        try:
+            return cls._plans[code]
+        except KeyError:
+            plan = cls._plans[code] = cls(code)
+            return plan
+
+    def __init__(self, code):
+        self.argcount = argcount = code.co_argcount
+        self.nlocals = len(code.co_varnames)
+        kwonlycount = getattr(code, 'co_kwonlyargcount', 0)
+        i = argcount + kwonlycount
+        self.argindex = dict((name, i) for i, name in
+                             enumerate(code.co_varnames[:i]))
+        # (index, name) of the keyword-only arguments
+        self.kwonly = tuple(enumerate(code.co_varnames[argcount:i], argcount))
+        self.varargs = self.varkw = None
+        if code.co_flags & CO_VARARGS:
+            self.varargs = i
+            i += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            self.varkw = i
+        # a call passing exactly `argcount` positional arguments and nothing
+        # else just pads them out to the locals
+        self.simple = (self.varargs is None and self.varkw is None and
+                       not self.kwonly)
+        self.padding = [nil] * (self.nlocals - argcount)
+
+    def bind(self, args, kwargs, defaults, kwdefaults=None):
+        argcount = self.argcount
+        nargs = len(args)
+        if self.simple and nargs == argcount and not kwargs:
+            return list(args) + self.padding
+
+        if nargs > argcount:
+            if self.varargs is None:
+                return None
+            fastlocals = list(args[:argcount])
+            fastlocals.extend(self.padding)
+            fastlocals[self.varargs] = tuple(args[argcount:])
+        else:
+            fastlocals = list(args)
+            fastlocals.extend([nil] * (self.nlocals - nargs))
+            if self.varargs is not None:
+                fastlocals[self.varargs] = ()
+
+        if self.varkw is not None:
+            extra = fastlocals[self.varkw] = {}
+        if kwargs:
+            argindex = self.argindex
+            for name, val in six.iteritems(kwargs):
+                i = argindex.get(name)
+                if i is None:
+                    if self.varkw is None:
+                        return None
+                    extra[name] = val
+                elif fastlocals[i] is not nil:
+                    return None
+                else:
+                    fastlocals[i] = val
+
+        if nargs < argcount:
+            first_default = argcount - len(defaults)
+            for i in range(nargs, argcount):
+                if fastlocals[i] is nil:
+                    if i < first_default:
+                        return None
+                    fastlocals[i] = defaults[i - first_default]
+        for i, name in self.kwonly:
+            if fastlocals[i] is nil:
+                if not kwdefaults or name not in kwdefaults:
+                    return None
+                fastlocals[i] = kwdefaults[name]
+        return fastlocals
+
 
 class Function(object):
-    def __init__(self, code, defaults, closure, vm):
+    # __dict__ for attributes guest code sets on its functions
+    __slots__ = ('func_code', 'func_name', '__name__', '__qualname__',
+                 'func_defaults', 'func_kwdefaults', 'func_closure',
+                 'func_globals', '_vm', '_plan', '_func', '__dict__',
+                 '__weakref__')
+
+    def __init__(self, code, defaults, closure, vm, kwdefaults=None,
+                 qualname=None):
         self.func_code = code
         self.func_name = self.__name__ = code.co_name
-        self.func_defaults = defaults
+        self.__qualname__ = qualname or code.co_name
+        self.func_defaults = tuple(defaults)
+        self.func_kwdefaults = kwdefaults
         self.func_closure = closure
+        self.func_globals = vm.frame.f_globals
         self._vm = vm
-
-        if closure:
-            closure = tuple(make_cell(i) for i in closure)
-        self._func = types.FunctionType(code, vm.frame.f_globals, 
-                                              argdefs=tuple(defaults),
-                                              closure=closure)
-                                              
+        self._plan = ArgPlan.for_code(code)
+        self._func = None
+
+    # the Python 3 names
+    __code__ = property(lambda self: self.func_code)
+    __defaults__ = property(lambda self: self.func_defaults or None)
+    __kwdefaults__ = property(lambda self: self.func_kwdefaults)
+    __closure__ = property(lambda self: self.func_closure)
+    __globals__ = property(lambda self: self.func_globals)
+
+    def _getcallargs(self, *args, **kwargs):
+        # slow path: inspect a host function of the same shape, mostly to
+        # raise the same TypeError CPython would
+        if self._func is None:
+            closure = None
+            if self.func_closure:
+                closure = tuple(make_cell(cell.cell_contents)
+                                for cell in self.func_closure)
+            self._func = types.FunctionType(self.func_code, self.func_globals,
+                                            argdefs=self.func_defaults,
+                                            closure=closure)
+            if self.func_kwdefaults:
+                self._func.__kwdefaults__ = self.func_kwdefaults
+        return inspect.getcallargs(self._func, *args, **kwargs)
+
+    def make_call_frame(self, args, kwargs):
+        """Bind `args` and `kwargs` into a new frame for this function."""
+        fastlocals = self._plan.bind(args, kwargs, self.func_defaults,
+                                     self.func_kwdefaults)
+        if fastlocals is not None and not self.func_closure:
+            frame = self._vm.reuse_frame(self.func_code, self.func_globals,
+                                         fastlocals)
+            if frame is not None:
+                return frame
+        if fastlocals is None:
+            callargs = self._getcallargs(*args, **kwargs)
+        else:
+            callargs = {}
+        return self._vm.make_frame(self.func_code, callargs, self.func_globals,
+                                   {}, fastlocals, self.func_closure)
 
     def __call__(self, *args, **kwargs):
-        if  self.func_name in ["<setcomp>", "<dictcomp>", "<genexpr>"]:
-            #  http://bugs.python.org/issue19611 
-            assert len(args) == 1 and not kwargs, "Surprising comprehension!"
-            callargs = {".0": args[0]}
-        else:
-            callargs = inspect.getcallargs(self._func, *args, **kwargs)
-        for i, x in  enumerate(self.func_code.co_freevars):
-            callargs[x] = self.func_closure[i]
-        frame = self._vm.make_frame(self.func_code,callargs)
+        frame = self.make_call_frame(args, kwargs)
 
-        CO_GENERATOR = 32           
         if self.func_code.co_flags & CO_GENERATOR:
             gen = Generator(frame, self._vm)
             frame.generator = gen
+            # set again on every resume
+            frame.f_back = None
             r = gen
         else:
             r = self._vm.run_frame(frame)
         return r
 
+    def call_with_budget(self, args=(), kwargs=None, max_instructions=None,
+                         timeout=None):
+        """Call the function with `args` and `kwargs` like
+        `VirtualMachine.run_code` runs code, raising BudgetExceeded after
+        `max_instructions` instructions or `timeout` seconds.
+
+        """
+        if self.func_code.co_flags & CO_GENERATOR:
+            raise TypeError("a generator function runs as it is iterated")
+        frame = self.make_call_frame(args, kwargs or {})
+        return self._vm.run_limited(frame, max_instructions, timeout)
+
+    def _rebind(self, f_globals):
+        """A copy of the function that reads `f_globals` as its globals."""
+        func = object.__new__(Function)
+        for name in ('func_code', 'func_name', '__name__', '__qualname__',
+                     'func_defaults', 'func_kwdefaults', 'func_closure',
+                     '_vm', '_plan'):
+            setattr(func, name, getattr(self, name))
+        func.__dict__.update(self.__dict__)
+        func.func_globals = f_globals
+        func._func = None
+        return func
+
     def __get__(self, instance, owner):
         if instance is not None:
             return Method(instance, owner, self)
+        if PY3:
+            # no unbound methods in Python 3
+            return self
         return Method(None, owner, self)
         
 
 class Method(object):
+    __slots__ = ('im_self', 'im_class', 'im_func')
+
     def __init__(self, obj, _class, func):
         self.im_self = obj
         self.im_class = _class
@@ -118,6 +461,8 @@ class Method(object):
             return self.im_func(*args, **kwargs)
 
 class Generator(object):
+    __slots__ = ('gi_frame', 'vm', 'started', 'finished', '__weakref__')
+
     def __init__(self, g_frame, vm):
         self.gi_frame = g_frame
         self.vm = vm
@@ -130,6 +475,8 @@ class Generator(object):
     def next(self):
         return self.send(None)
 
+    __next__ = next
+
     def send(self, value=None):
         if not self.started and value is not None:
             raise TypeError("Can't send non-None value to a just-started generator")
@@ -140,18 +487,879 @@ class Generator(object):
             raise StopIteration(val)
         return val
 
+_GLOBAL_NAME_ERROR = ("global name '%s' is not defined" if PY2 else
+                      "name '%s' is not defined")
+
+_object_getattribute = object.__getattribute__
+
+
+def _unpack_error(expected, got):
+    """The ValueError for unpacking `got` values into `expected` names;
+    `got` is None when there were too many.
+
+    """
+    if got is None:
+        if PY2:
+            return ValueError("too many values to unpack")
+        return ValueError("too many values to unpack (expected %d)" % expected)
+    if PY2:
+        return ValueError("need more than %d value%s to unpack" %
+                          (got, "" if got == 1 else "s"))
+    return ValueError("not enough values to unpack (expected %d, got %d)" %
+                      (expected, got))
+
+# FORMAT_VALUE's conversions: none, !s, !r and !a
+_CONVERSIONS = (None, str, repr, getattr(six.moves.builtins, 'ascii', repr))
+
+class Task(object):
+    """A guest program interleaved with others by a VirtualMachine, see
+    `VirtualMachine.spawn`.
+
+    Once `done`, `result` holds what the code returned, or `exception`
+    and `traceback` what it raised.
+
+    """
+    __slots__ = ('name', 'root', 'frames', 'frame', 'last_exception',
+                 'exc_info', 'done', 'result', 'exception', 'traceback',
+                 'awaiting', 'pending')
+
+    def __init__(self, root, name=None):
+        self.name = name or root.f_code.co_name
+        self.root = root
+        # the VM's frame stack while the task is switched out
+        self.frames = []
+        self.frame = None
+        self.last_exception = None
+        self.exc_info = (None, None, None)
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.traceback = None
+        # the host awaitable the task waits for, and the exception to raise
+        # in it when it next runs
+        self.awaiting = None
+        self.pending = None
+
+    def __repr__(self):
+        state = 'done' if self.done else 'running' if self.frame else 'new'
+        return '<Task %s %s>' % (self.name, state)
+
+
+class Snapshot(object):
+    """Module globals as some setup code left them, for runs to start from.
+
+    Made by `VirtualMachine.snapshot`.  `clone` copies the globals for one
+    run: a name the run rebinds changes only its copy, but the objects the
+    names refer to are shared, so the tables the setup code built cost
+    nothing to clone and are best left unchanged.  Guest functions held
+    directly in the globals are copied to read the clone's globals; ones
+    reached otherwise, such as methods, go on reading the snapshot's.  For
+    runs that may change anything, see `vmbatch.run_forked`.
+
+    """
+    def __init__(self, vm, f_globals):
+        self.vm = vm
+        self.f_globals = f_globals
+        self._functions = [(name, value) for name, value in f_globals.items()
+                           if type(value) is Function and
+                           value.func_globals is f_globals]
+
+    def clone(self):
+        f_globals = VersionedDict(self.f_globals)
+        for name, func in self._functions:
+            f_globals[name] = func._rebind(f_globals)
+        return f_globals
+
+    def run_code(self, code, max_instructions=None, timeout=None):
+        """Run `code` on the snapshot's VM in a clone of its globals."""
+        return self.vm.run_code(code, max_instructions, timeout,
+                                f_globals=self.clone())
+
+
+class GuestCoroutine(object):
+    """The coroutine `VirtualMachine.run_code_async` returns.
+
+    Written out by hand rather than as a generator so that it can return
+    a value on Python 2's syntax too.  Each step runs the task for
+    `quantum` instructions and then yields to the event loop, or goes on
+    to drive the host awaitable the guest is waiting for.
+
+    """
+    def __init__(self, vm, task, quantum):
+        self.vm = vm
+        self.task = task
+        self.quantum = quantum
+        # the __await__ iterator of the host awaitable being waited for
+        self._awaiting = None
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    next = __next__
+
+    def send(self, value):
+        return self._resume(value, None)
+
+    def throw(self, typ, val=None, tb=None):
+        if val is None:
+            val = typ() if isinstance(typ, type) else typ
+        return self._resume(None, val)
+
+    def close(self):
+        if self._awaiting is not None and hasattr(self._awaiting, 'close'):
+            self._awaiting.close()
+        self._awaiting = None
+        self.task.done = True
+
+    def _resume(self, value, exc):
+        task = self.task
+        if task.done:
+            raise RuntimeError("cannot reuse already awaited coroutine")
+        while True:
+            awaiting = self._awaiting
+            if awaiting is not None:
+                try:
+                    if exc is None:
+                        return awaiting.send(value)
+                    return awaiting.throw(exc)
+                except StopIteration as e:
+                    # what the guest's call evaluates to
+                    task.frame.stack.append(e.value)
+                except Exception as e:
+                    task.pending = e
+                self._awaiting = None
+            elif exc is not None:
+                task.pending = exc
+            value = exc = None
+
+            self.vm._run_task(task, self.quantum, await_calls=True)
+            if task.done:
+                if task.exception is not None:
+                    raise task.exception
+                raise StopIteration(task.result)
+            if task.awaiting is None:
+                # the quantum is used up: let the event loop run
+                return None
+            awaiting, task.awaiting = task.awaiting, None
+            if hasattr(awaiting, '__await__'):
+                awaiting = awaiting.__await__()
+            self._awaiting = awaiting
+
+
 #nil = object()
 class nil(object):
     pass
 
 
+def _unknown_bytecode(byteName):
+    def bytecode_fn(vm, *arguments):
+        raise VirtualMachineError("unknown bytecode type: %s" % byteName)
+    bytecode_fn.__name__ = byteName
+    return bytecode_fn
+
+
+HASCONST = frozenset(dis.hasconst)
+HASNAME = frozenset(dis.hasname)
+HASJREL = frozenset(dis.hasjrel)
+HASJABS = frozenset(dis.hasjabs)
+# opcodes whose handler takes a site key for its inline cache after its
+# argument, see VersionedDict.sites
+HASCACHE = frozenset([dis.opmap['LOAD_GLOBAL'], dis.opmap['LOAD_NAME']])
+
+def _decode_arguments(code, byteCode, intArg, next_offset):
+    if byteCode in HASCONST:
+        arg = code.co_consts[intArg]
+    elif byteCode in HASNAME:
+        arg = code.co_names[intArg]
+    elif byteCode in HASJREL:
+        arg = next_offset + intArg
+    else:
+        # includes HASJABS, HASLOCAL and HASFREE: jump targets, fast locals
+        # and cells are addressed by number
+        arg = intArg
+    if byteCode in HASCACHE:
+        return (arg, object())
+    return (arg,)
+
+
+def decode_code(code, table):
+    """Decode `code.co_code` into a list indexed by byte offset.
+
+    Every instruction start holds `(handler, arguments, next_offset)`, where
+    `handler` comes from the opcode-indexed dispatch `table` and the
+    argument is already resolved against the code object's tables; the
+    bytes in between hold None.  Handles the 1-or-3-byte instructions of
+    Python 2 and the wordcode of Python 3.6+.
+
+    """
+    co_code = bytearray(code.co_code)
+    instrs = [None] * len(co_code)
+    offset = start = extended = 0
+    while offset < len(co_code):
+        byteCode = co_code[offset]
+        arguments = ()
+        if WORDCODE:
+            next_offset = offset + 2
+            if byteCode == dis.EXTENDED_ARG:
+                extended = (extended | co_code[offset + 1]) << 8
+                offset = next_offset
+                continue
+            if byteCode >= dis.HAVE_ARGUMENT:
+                intArg = co_code[offset + 1] | extended
+                arguments = _decode_arguments(code, byteCode, intArg,
+                                              next_offset)
+        else:
+            next_offset = offset + 1
+            if byteCode >= dis.HAVE_ARGUMENT:
+                intArg = co_code[next_offset] + (co_code[next_offset+1] << 8)
+                intArg |= extended
+                next_offset += 2
+                if byteCode == dis.EXTENDED_ARG:
+                    extended = intArg << 16
+                    offset = next_offset
+                    continue
+                arguments = _decode_arguments(code, byteCode, intArg,
+                                              next_offset)
+        # a jump to a preceding EXTENDED_ARG runs the whole instruction
+        instrs[start] = instrs[offset] = (table[byteCode], arguments, next_offset)
+        offset = start = next_offset
+        extended = 0
+    return instrs
+
+
+def fuse_superinstructions(instrs, cls):
+    """Return a copy of `instrs` with common opcode sequences fused.
+
+    A sequence listed in `cls.SUPERINSTRUCTIONS` is replaced, at the offset
+    of its first instruction, by one entry calling the combined handler with
+    all the arguments and continuing after the last instruction.  The
+    entries of the later instructions stay in place, so a jump into the
+    middle of a sequence runs the rest of it unfused.
+
+    """
+    fused = list(instrs)
+    offset = 0
+    while offset < len(instrs):
+        entry = instrs[offset]
+        if entry is None:
+            # dropped by optimize_stream
+            offset += 1
+            continue
+        for names, fused_name in cls.SUPERINSTRUCTIONS:
+            arguments = ()
+            next_offset = offset
+            for name in names:
+                if next_offset >= len(instrs):
+                    break
+                part = instrs[next_offset]
+                if part is None or part[0].__name__ != name:
+                    break
+                arguments += part[1]
+                next_offset = part[2]
+            else:
+                handler = six.get_unbound_function(getattr(cls, fused_name))
+                fused[offset] = (handler, arguments, next_offset)
+                break
+        offset = entry[2]
+    return fused
+
+
+# constant folding, see optimize_stream
+_FOLD_UNARY = {
+    'UNARY_POSITIVE': operator.pos,
+    'UNARY_NEGATIVE': operator.neg,
+    'UNARY_INVERT': operator.invert,
+    'UNARY_NOT': operator.not_,
+    'UNARY_CONVERT': repr,
+}
+_FOLD_BINARY = {
+    'BINARY_ADD': operator.add,
+    'BINARY_SUBTRACT': operator.sub,
+    'BINARY_MULTIPLY': operator.mul,
+    'BINARY_TRUE_DIVIDE': operator.truediv,
+    'BINARY_FLOOR_DIVIDE': operator.floordiv,
+    'BINARY_MODULO': operator.mod,
+    'BINARY_POWER': operator.pow,
+    'BINARY_SUBSCR': operator.getitem,
+    'BINARY_LSHIFT': operator.lshift,
+    'BINARY_RSHIFT': operator.rshift,
+    'BINARY_AND': operator.and_,
+    'BINARY_XOR': operator.xor,
+    'BINARY_OR': operator.or_,
+}
+if PY2:
+    _FOLD_BINARY['BINARY_DIVIDE'] = operator.div
+# only values of these exact types (and tuples and frozensets of them) are
+# folded
+_CONSTANT_TYPES = frozenset((bool, float, complex, type(None), bytes,
+                             six.text_type) + six.integer_types)
+# folds bigger than this are left to run time, like CPython's peephole
+# optimizer does
+_MAX_FOLDED_SIZE = 20
+_MAX_FOLDED_BITS = 128
+_UNCONDITIONAL_JUMPS = frozenset(['JUMP_ABSOLUTE', 'JUMP_FORWARD'])
+_THREADED_JUMPS = _UNCONDITIONAL_JUMPS | frozenset(
+    ['POP_JUMP_IF_TRUE', 'POP_JUMP_IF_FALSE'])
+# never go on to the next instruction
+_NO_FALLTHROUGH = _UNCONDITIONAL_JUMPS | frozenset(
+    ['RETURN_VALUE', 'RAISE_VARARGS', 'BREAK_LOOP', 'CONTINUE_LOOP'])
+
+
+def _is_constant(value):
+    if type(value) in (tuple, frozenset):
+        return all(_is_constant(v) for v in value)
+    return type(value) in _CONSTANT_TYPES
+
+
+def _fold(op, values):
+    """Return `op(*values)`, or nil when it is better left to run time."""
+    if not all(_is_constant(v) for v in values):
+        return nil
+    if len(values) == 2:
+        a, b = values
+        ints = isinstance(a, six.integer_types) and isinstance(b, six.integer_types)
+        if op is operator.pow and ints and b > 0:
+            if abs(a).bit_length() * b > _MAX_FOLDED_BITS:
+                return nil
+        elif op is operator.lshift and ints and b > _MAX_FOLDED_BITS:
+            return nil
+        elif op is operator.mul:
+            if isinstance(a, six.integer_types):
+                a, b = b, a
+            if (isinstance(b, six.integer_types) and hasattr(a, '__len__')
+                    and len(a) * b > _MAX_FOLDED_SIZE):
+                return nil
+    try:
+        value = op(*values)
+    except Exception:
+        # raises when it runs
+        return nil
+    if not _is_constant(value):
+        return nil
+    if hasattr(value, '__len__') and len(value) > _MAX_FOLDED_SIZE:
+        return nil
+    return value
+
+
+def _fold_at(stream, offset, load_const, cls):
+    """Fold the constants loaded from `offset` on with the instruction
+    consuming them, returning whether anything changed.
+
+    """
+    entry = stream[offset]
+    if entry is None or entry[0].__name__ != 'LOAD_CONST':
+        return False
+    values = []
+    next_offset = offset
+    while next_offset < len(stream):
+        entry = stream[next_offset]
+        if entry is None or entry[0].__name__ != 'LOAD_CONST':
+            break
+        values.append(entry[1][0])
+        next_offset = entry[2]
+    else:
+        return False
+    if entry is None:
+        return False
+    handler, arguments, after = entry
+    name = handler.__name__
+    if name == 'BUILD_TUPLE' and arguments[0] == len(values):
+        value = tuple(values) if _is_constant(tuple(values)) else nil
+    elif name in _FOLD_UNARY and len(values) == 1:
+        value = _fold(_FOLD_UNARY[name], values)
+    elif name in _FOLD_BINARY and len(values) == 2:
+        value = _fold(_FOLD_BINARY[name], values)
+    elif name == 'COMPARE_OP' and len(values) == 2 and arguments[0] < 8:
+        # not `is`, `is not` or exception matching
+        value = _fold(cls.COMPARE_OPERATORS[arguments[0]], values)
+    else:
+        return False
+    if value is nil:
+        return False
+    stream[offset] = (load_const, (value,), after)
+    return True
+
+
+def _thread_jumps(stream):
+    for offset, entry in enumerate(stream):
+        if entry is None or entry[0].__name__ not in _THREADED_JUMPS:
+            continue
+        target = entry[1][0]
+        seen = set()
+        while target not in seen:
+            seen.add(target)
+            hop = stream[target]
+            if hop is None or hop[0].__name__ not in _UNCONDITIONAL_JUMPS:
+                break
+            target = hop[1][0]
+        if (entry[0].__name__ in _UNCONDITIONAL_JUMPS and
+                stream[target][0].__name__ == 'RETURN_VALUE'):
+            stream[offset] = stream[target]
+        elif target != entry[1][0]:
+            stream[offset] = (entry[0], (target,) + entry[1][1:], entry[2])
+
+
+def _drop_unreachable(stream):
+    reachable = set()
+    todo = [0]
+    while todo:
+        offset = todo.pop()
+        if offset in reachable or offset >= len(stream):
+            continue
+        reachable.add(offset)
+        handler, arguments, next_offset = stream[offset]
+        name = handler.__name__
+        op = dis.opmap.get(name)
+        if op in HASJREL or op in HASJABS:
+            todo.append(arguments[0])
+        if name not in _NO_FALLTHROUGH:
+            todo.append(next_offset)
+    for offset in range(len(stream)):
+        if offset not in reachable:
+            stream[offset] = None
+
+
+def optimize_stream(instrs, cls):
+    """Return a copy of `instrs` with constant expressions folded, jumps to
+    jumps threaded and unreachable instructions dropped.
+
+    Like the fusing of superinstructions this only rewrites entries: a
+    folded LOAD_CONST sits where the first constant was loaded and skips
+    to after the instruction it replaces, and dropped entries become None.
+
+    """
+    stream = list(instrs)
+    load_const = six.get_unbound_function(cls.LOAD_CONST)
+    # backwards, so that operands are folded before what uses them
+    for offset in reversed(range(len(stream))):
+        while _fold_at(stream, offset, load_const, cls):
+            pass
+    _thread_jumps(stream)
+    _drop_unreachable(stream)
+    return stream
+
+
+# (pops, pushes) of what may come between a method's LOAD_ATTR and the
+# CALL_FUNCTION calling it; anything else leaves the call alone
+_ARGUMENT_EFFECTS = dict(
+    [(name, (0, 1)) for name in ('LOAD_FAST', 'LOAD_CONST', 'LOAD_NAME',
+                                 'LOAD_GLOBAL', 'LOAD_DEREF', 'BUILD_MAP')] +
+    [(name, (1, 1)) for name in ('LOAD_ATTR', 'UNARY_POSITIVE',
+                                 'UNARY_NEGATIVE', 'UNARY_NOT',
+                                 'UNARY_INVERT', 'SLICE0')] +
+    [(name, (2, 1)) for name in ('BINARY_ADD', 'BINARY_SUBTRACT',
+                                 'BINARY_MULTIPLY', 'BINARY_DIVIDE',
+                                 'BINARY_FLOOR_DIVIDE', 'BINARY_TRUE_DIVIDE',
+                                 'BINARY_MODULO', 'BINARY_POWER',
+                                 'BINARY_SUBSCR', 'BINARY_LSHIFT',
+                                 'BINARY_RSHIFT', 'BINARY_AND', 'BINARY_XOR',
+                                 'BINARY_OR', 'COMPARE_OP')] +
+    [('STORE_MAP', (3, 1))])
+_BUILDS = frozenset(['BUILD_TUPLE', 'BUILD_LIST', 'BUILD_SET'])
+
+
+def _jump_targets(instrs):
+    targets = set()
+    for entry in instrs:
+        if entry is not None:
+            op = dis.opmap.get(entry[0].__name__)
+            if op in HASJREL or op in HASJABS:
+                targets.add(entry[1][0])
+    return targets
+
+
+def _method_call(instrs, offset, targets):
+    """Return the offset of the CALL_FUNCTION calling what the LOAD_ATTR at
+    `offset` loads with positional arguments only, or None.
+
+    """
+    depth = 0  # values above the attribute
+    offset = instrs[offset][2]
+    while offset < len(instrs) and offset not in targets:
+        handler, arguments, next_offset = instrs[offset]
+        name = handler.__name__
+        if name == 'CALL_FUNCTION':
+            nargs = arguments[0] & 0xFF
+            nargs += 2 * (arguments[0] >> 8)
+            if nargs == depth:
+                return offset if nargs == arguments[0] else None
+            pops, pushes = nargs + 1, 1
+        elif name in _BUILDS:
+            pops, pushes = arguments[0], 1
+        elif name in _ARGUMENT_EFFECTS:
+            pops, pushes = _ARGUMENT_EFFECTS[name]
+        else:
+            return None
+        if pops > depth:
+            # the attribute is used for something else
+            return None
+        depth += pushes - pops
+        offset = next_offset
+    return None
+
+
+def pair_method_calls(instrs, cls):
+    """Return a copy of `instrs` where `obj.name(args)` calls run as
+    LOAD_METHOD and CALL_METHOD, like Python 3.7 compiles them.
+
+    The pair is only formed when nothing can jump between the LOAD_ATTR
+    and the CALL_FUNCTION; this is what lets LOAD_METHOD leave two values
+    for CALL_METHOD where the original code expects one.
+
+    """
+    paired = list(instrs)
+    targets = _jump_targets(instrs)
+    load_method = six.get_unbound_function(cls.LOAD_METHOD)
+    call_method = six.get_unbound_function(cls.CALL_METHOD)
+    for offset, entry in enumerate(instrs):
+        if entry is None or entry[0].__name__ != 'LOAD_ATTR':
+            continue
+        call = _method_call(instrs, offset, targets)
+        if call is not None:
+            paired[offset] = (load_method,) + entry[1:]
+            paired[call] = (call_method,) + instrs[call][1:]
+    return paired
+
+
+def log_tracer(frame, offset, byteName, arguments):
+    """A tracer logging every instruction with the frame's stacks."""
+    logging.info(str(frame.stack))
+    logging.info(str(frame.block_stack))
+    logging.info("%d %s %s", offset, byteName, arguments)
+
+
+def line_number(code, offset):
+    """The source line of the instruction at `offset` in `code`."""
+    lineno = code.co_firstlineno
+    for start, line in dis.findlinestarts(code):
+        if start > offset:
+            break
+        lineno = line
+    return lineno
+
+
+class Traceback(object):
+    """A guest traceback entry, shaped like a host traceback object.
+
+    `tb_frame` was running the instruction at `tb_lasti` when the exception
+    passed through it; `tb_next` leads towards where it was raised.
+
+    """
+    __slots__ = ('tb_frame', 'tb_lasti', 'tb_next')
+
+    def __init__(self, frame, tb_next=None):
+        self.tb_frame = frame
+        frame.escaped = True
+        # f_lasti already points past the instruction that raised
+        offset = frame.f_lasti - 1
+        instrs = frame.instrs
+        while offset > 0 and instrs[offset] is None:
+            offset -= 1
+        self.tb_lasti = offset
+        self.tb_next = tb_next
+
+    @property
+    def tb_lineno(self):
+        return line_number(self.tb_frame.f_code, self.tb_lasti)
+
+    def __repr__(self):
+        return '<Traceback %s line %d>' % (self.tb_frame.f_code.co_name,
+                                           self.tb_lineno)
+
+
+# part of every StreamCache key; bump it when the streams a VM builds change
+STREAM_CACHE_VERSION = 1
+
+
+def _nested_code(code, path=()):
+    """Yield `(path, code)` for `code` and the code objects in its
+    constants, `path` being the co_consts indices leading there.
+
+    """
+    yield path, code
+    for i, const in enumerate(code.co_consts):
+        if isinstance(const, types.CodeType):
+            for item in _nested_code(const, path + (i,)):
+                yield item
+
+
+class StreamCache(object):
+    """Decoded instruction streams kept in `directory` across processes.
+
+    Attach with `VirtualMachine(stream_cache=StreamCache(directory))`.  The
+    streams of a code object and of all the code nested in it are saved in
+    one file, keyed by the marshalled code, the VM class and its passes;
+    loading that file, through mmap, stands in for decoding all of them.
+    Files are written atomically, so many processes can share a directory.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def key(self, code, cls, passes):
+        digest = hashlib.sha1(marshal.dumps(code))
+        digest.update(repr((cls.__module__, cls.__name__, passes,
+                            STREAM_CACHE_VERSION,
+                            sys.version_info[:2])).encode('ascii'))
+        return digest.hexdigest()
+
+    def load(self, key, code, cls):
+        """Return `[(code, stream)]` for `code` and its nested code as
+        saved under `key` by VMs of `cls`, or None.
+
+        """
+        try:
+            f = open(os.path.join(self.directory, key), 'rb')
+        except (IOError, OSError):
+            return None
+        with f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                return None
+            try:
+                names, streams = marshal.loads(mapped if PY3 else mapped[:])
+            except (EOFError, ValueError, TypeError):
+                return None
+            finally:
+                mapped.close()
+
+        table = dict((handler.__name__, handler)
+                     for handler in cls._dispatch_table)
+        try:
+            handlers = [table.get(name) or
+                        six.get_unbound_function(getattr(cls, name))
+                        for name in names]
+        except AttributeError:
+            return None
+        loaded = []
+        for path, entries in streams:
+            nested = code
+            for i in path:
+                nested = nested.co_consts[i]
+            instrs = []
+            for entry in entries:
+                if entry is not None:
+                    index, arguments, next_offset, refs = entry
+                    if refs:
+                        arguments = list(arguments)
+                        for i, const in refs:
+                            # a fresh inline cache key, see
+                            # VersionedDict.sites, or a code object
+                            arguments[i] = (object() if const < 0 else
+                                            nested.co_consts[const])
+                        arguments = tuple(arguments)
+                    entry = (handlers[index], arguments, next_offset)
+                instrs.append(entry)
+            loaded.append((nested, instrs))
+        return loaded
+
+    def store(self, key, streams):
+        """Save `[(code, stream)]` under `key`, the first being the code
+        the key is for and the rest its nested code.
+
+        """
+        paths = dict((id(nested), path)
+                     for path, nested in _nested_code(streams[0][0]))
+        names = []
+        indices = {}
+        saved = []
+        for nested, instrs in streams:
+            entries = []
+            for entry in instrs:
+                if entry is None:
+                    entries.append(None)
+                    continue
+                handler, arguments, next_offset = entry
+                name = handler.__name__
+                if name not in indices:
+                    indices[name] = len(names)
+                    names.append(name)
+                refs = []
+                for i, arg in enumerate(arguments):
+                    if type(arg) is object:
+                        refs.append((i, -1))
+                    elif isinstance(arg, types.CodeType):
+                        if arg not in nested.co_consts:
+                            return
+                        refs.append((i, nested.co_consts.index(arg)))
+                if refs:
+                    arguments = list(arguments)
+                    for i, const in refs:
+                        arguments[i] = None
+                    arguments = tuple(arguments)
+                entries.append((indices[name], arguments, next_offset,
+                                tuple(refs)))
+            saved.append((paths[id(nested)], tuple(entries)))
+        try:
+            data = marshal.dumps((tuple(names), tuple(saved)))
+        except ValueError:
+            # an argument marshal can't write
+            return
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(path, os.path.join(self.directory, key))
+        except EnvironmentError:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Profiler(object):
+    """Per-instruction execution counts and handler times.
+
+    Attach with `VirtualMachine(profiler=Profiler())`.  Every instruction
+    run is recorded against its code object and offset; the time is that of
+    the bytecode handler, so a CALL_FUNCTION into host code includes the
+    host call (and any guest code it runs again).
+
+    """
+    def __init__(self, timer=timeit.default_timer):
+        self.timer = timer
+        # (code, offset) -> [opname, count, time]
+        self.stats = {}
+
+    def record(self, code, offset, opname, elapsed):
+        try:
+            stat = self.stats[code, offset]
+        except KeyError:
+            stat = self.stats[code, offset] = [opname, 0, 0.0]
+        stat[1] += 1
+        stat[2] += elapsed
+
+    def clear(self):
+        self.stats.clear()
+
+    def opcode_stats(self):
+        """Totals per opcode name, as {opname: [count, time]}."""
+        totals = {}
+        for opname, count, elapsed in self.stats.values():
+            total = totals.setdefault(opname, [0, 0.0])
+            total[0] += count
+            total[1] += elapsed
+        return totals
+
+    def get_stats(self):
+        """All the data as a JSON-serializable dict."""
+        instructions = []
+        for (code, offset), (opname, count, elapsed) in self.stats.items():
+            instructions.append({
+                'filename': code.co_filename,
+                'name': code.co_name,
+                'firstlineno': code.co_firstlineno,
+                'offset': offset,
+                'line': line_number(code, offset),
+                'opname': opname,
+                'count': count,
+                'time': elapsed,
+            })
+        instructions.sort(key=lambda i: (i['filename'], i['firstlineno'],
+                                         i['name'], i['offset']))
+        opcodes = dict((opname, {'count': count, 'time': elapsed})
+                       for opname, (count, elapsed)
+                       in self.opcode_stats().items())
+        return {'instructions': instructions, 'opcodes': opcodes}
+
+    def dump_stats(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.get_stats(), f, indent=1, sort_keys=True)
+
+    def print_stats(self, sort='time', limit=None, stream=None):
+        """Print a pstats-style report sorted by 'time' or 'count'."""
+        stream = stream or sys.stdout
+        key = {'count': lambda row: row[1],
+               'time': lambda row: row[2]}[sort]
+        opcodes = [(opname, count, elapsed) for opname, (count, elapsed)
+                   in self.opcode_stats().items()]
+        opcodes.sort(key=key, reverse=True)
+        total_count = sum(row[1] for row in opcodes)
+        total_time = sum(row[2] for row in opcodes)
+        stream.write("         %d instructions in %.3f seconds\n\n"
+                     % (total_count, total_time))
+
+        stream.write("   ncalls  tottime  percall  opcode\n")
+        for opname, count, elapsed in opcodes[:limit]:
+            stream.write("%9d %8.3f %8.3g  %s\n"
+                         % (count, elapsed, elapsed / count, opname))
+
+        rows = [(code, offset, stat) for (code, offset), stat
+                in self.stats.items()]
+        rows.sort(key=lambda row: key(row[2]), reverse=True)
+        stream.write("\n   ncalls  tottime  percall  "
+                     "filename:lineno(function) offset opcode\n")
+        for code, offset, (opname, count, elapsed) in rows[:limit]:
+            stream.write("%9d %8.3f %8.3g  %s:%d(%s) %d %s\n"
+                         % (count, elapsed, elapsed / count,
+                            code.co_filename, line_number(code, offset),
+                            code.co_name, offset, opname))
+
+
 class VirtualMachine(object):
     
     HAVE_ARGUMENT = 90
 
-    def __init__(self):
+    # guest calls don't use the host stack, so this is independent of
+    # sys.getrecursionlimit()
+    recursion_limit = 10000
+
+    # opcode sequences run by one combined handler, see
+    # fuse_superinstructions
+    SUPERINSTRUCTIONS = [
+        (('LOAD_FAST', 'LOAD_FAST', 'BINARY_ADD'),
+         'LOAD_FAST_LOAD_FAST_BINARY_ADD'),
+        (('LOAD_FAST', 'LOAD_ATTR'), 'LOAD_FAST_LOAD_ATTR'),
+        (('LOAD_CONST', 'RETURN_VALUE'), 'LOAD_CONST_RETURN_VALUE'),
+        (('COMPARE_OP', 'POP_JUMP_IF_FALSE'), 'COMPARE_OP_POP_JUMP_IF_FALSE'),
+        (('FOR_ITER', 'STORE_FAST'), 'FOR_ITER_STORE_FAST'),
+    ]
+
+    def __init__(self, tracer=None, profiler=None, superinstructions=True,
+                 optimize=False, stream_cache=None):
+        if '_dispatch_table' not in type(self).__dict__:
+            type(self)._build_dispatch_table()
         self._reset()
 
+        # run the SUPERINSTRUCTIONS fused; switch off to compare
+        self.superinstructions = superinstructions
+        # run code through optimize_stream first
+        self.optimize = optimize
+        # a StreamCache to share decoded streams with other processes
+        self.stream_cache = stream_cache
+        # spawned tasks waiting for a turn, see `join`
+        self.tasks = collections.deque()
+        # whether a host awaitable returned to guest code suspends the guest,
+        # see `run_code_async`
+        self.await_calls = False
+        # the instructions and the timeit.default_timer() deadline a
+        # `run_limited` run has left, None outside of one
+        self.instructions_left = None
+        self.deadline = None
+        # what a counted run loop had left of its budget when it returned
+        self.budget_left = 0
+
+        # the builtins namespace of every frame
+        self.builtins = vars(six.moves.builtins)
+        # code object -> returned frames to reuse, see release_frame
+        self._frame_pool = {}
+
+        # called as tracer(frame, offset, byteName, arguments) before every
+        # instruction; only looked at when a frame starts running
+        self.tracer = tracer
+        # a Profiler, looked at when a frame starts running
+        self.profiler = profiler
+
         self.table = lambda x : x
 
     def _reset(self):
@@ -164,11 +1372,23 @@ class VirtualMachine(object):
         #refactor
         self.return_value = None
         self.last_exception = None
+        # the exception an except clause is handling, for Python 3's bare
+        # `raise`
+        self.exc_info = (None, None, None)
 
 
-    def run_code(self, code):
-        frame = self.make_frame(code)
-        val = self.run_frame(frame)
+    def run_code(self, code, max_instructions=None, timeout=None,
+                 f_globals=None):
+        """Run `code` as a module, in fresh globals or in `f_globals`.  With
+        `max_instructions` or `timeout` (in seconds), BudgetExceeded is
+        raised once either runs out.
+
+        """
+        frame = self.make_frame(code, f_globals=f_globals)
+        if max_instructions is None and timeout is None:
+            val = self.run_frame(frame)
+        else:
+            val = self.run_limited(frame, max_instructions, timeout)
         if self.frames:            
             raise VirtualMachineError("Frames left over!")
         if self.frame and self.frame.stack:             
@@ -184,31 +1404,372 @@ class VirtualMachine(object):
         return val
 
     def run_frame(self, frame):
+        """Run `frame` until it returns, yields or raises.
+
+        Calls from guest code to guest functions don't recurse into
+        run_frame: the callee frame is pushed and runs in the same loop, and
+        the loop only stops once `frame` itself is done.
+
+        """
         self.push_frame(frame)
+        # under a host call: awaitables can't suspend the guest here
+        await_calls, self.await_calls = self.await_calls, False
+        if self.instructions_left is not None:
+            why = self._run_limited(frame)
+        elif self.tracer is None and self.profiler is None:
+            why = self._run_fast(frame)
+        else:
+            why = self._run_traced(frame, self.tracer, self.profiler)
+        self.await_calls = await_calls
+        self.pop_frame()
+        if why == WHY_EXCEPTION:
+            # 交给上层frame处理异常; the guest traceback stays in
+            # last_exception, where a calling frame picks it up again
+            exctype, val, tb = self.last_exception
+            six.reraise(exctype, val)
+        if why == WHY_RETURN:
+            self.release_frame(frame)
+
+        return self.return_value
+
+    def snapshot(self, code):
+        """Run the setup `code` as a module and return a Snapshot of the
+        globals it leaves, for runs to start from without running it again.
+
+        """
+        f_globals = self._module_globals()
+        self.run_code(code, f_globals=f_globals)
+        return Snapshot(self, f_globals)
+
+    # how many instructions run between reads of the clock under a deadline
+    clock_interval = 1000
+
+    def run_limited(self, frame, max_instructions=None, timeout=None):
+        """Run `frame` like `run_frame`, raising BudgetExceeded once it, and
+        any guest code host code calls back into meanwhile, has run
+        `max_instructions` instructions or `timeout` seconds have passed.
+
+        """
+        if self.instructions_left is not None:
+            raise VirtualMachineError("already running under a budget")
+        if max_instructions is None:
+            max_instructions = float('inf')
+        self.instructions_left = max_instructions
+        if timeout is not None:
+            self.deadline = timeit.default_timer() + timeout
+        try:
+            return self.run_frame(frame)
+        except BudgetExceeded:
+            self._reset()
+            raise
+        finally:
+            self.instructions_left = self.deadline = None
+
+    def _run_limited(self, entry):
+        """Run from `entry` in counted steps of at most `clock_interval`
+        instructions, charged to `instructions_left` up front so that
+        nested runs see what is left, and checking the clock in between.
+
+        """
+        tracer, profiler = self.tracer, self.profiler
         while True:
-            logging.info(str(frame.stack))
-            logging.info(str(frame.block_stack))
-            byteName, arguments, opoffset = self.parse_byte()
-            why = self.dispatch(byteName, arguments)
+            step = min(self.instructions_left, self.clock_interval)
+            late = (self.deadline is not None and
+                    timeit.default_timer() > self.deadline)
+            if step <= 0 or late:
+                # stays spent, however the guest handles the error
+                self.instructions_left = 0
+                while self.frame is not entry:
+                    self.pop_frame()
+                self.pop_frame()
+                raise BudgetExceeded("deadline passed" if late else
+                                     "instruction budget used up")
+            self.instructions_left -= step
+            if tracer is None and profiler is None:
+                why = self._run_counted(entry, step)
+            else:
+                why = self._run_traced(entry, tracer, profiler, step)
+            self.instructions_left += self.budget_left
+            if why != WHY_SUSPEND:
+                return why
 
-            if why == 'return':
-                break
-            
-            if why == 'reraise':
-                why = 'exception'
+    ## Tasks
+
+    def spawn(self, code, *args, **kwargs):
+        """Make a Task running `code` for `join` to run.
+
+        `code` is a code object, run as a module in fresh globals (or in
+        the `f_globals` keyword argument), or a guest function to call with
+        `args` and `kwargs`.
+
+        """
+        task = self._make_task(code, args, kwargs)
+        self.tasks.append(task)
+        return task
+
+    def run_code_async(self, code, quantum=None, f_globals=None):
+        """Return a coroutine running `code` like `run_code` does, but
+        yielding to the event loop every `quantum` instructions
+        (`task_slice` by default).
 
-            if why != 'yield':
-                if why and frame.block_stack:
-                    why = self.manage_block_stack(why)
+        When a guest call returns a host awaitable it is awaited, and the
+        call evaluates to its result; meanwhile only the guest code waits.
+        Guest code that host code calls back into can't be suspended, so
+        there the awaitable is returned as it is.
+
+        """
+        if PY2:
+            raise VirtualMachineError("run_code_async needs Python 3")
+        task = self._make_task(code, (), {'f_globals': f_globals})
+        return GuestCoroutine(self, task, quantum or self.task_slice)
+
+    def _make_task(self, code, args, kwargs):
+        if isinstance(code, Function):
+            if code.func_code.co_flags & CO_GENERATOR:
+                raise TypeError("can't spawn a generator function")
+            root = code.make_call_frame(args, kwargs)
+        else:
+            f_globals = kwargs.pop('f_globals', None)
+            if args or kwargs:
+                raise TypeError("a code object takes no arguments")
+            if f_globals is None:
+                f_globals = self._module_globals()
+            root = self.make_frame(code, f_globals=f_globals)
+        # tasks don't return into whatever spawned them
+        root.f_back = None
+        return Task(root)
+
+    def join(self, *tasks):
+        """Run the spawned tasks, `task_slice` instructions at a time in
+        turn, until all of `tasks` are done, or every task if none are
+        given.
+
+        Calls into guest code from host code, generators included, run to
+        completion within a turn.
+
+        """
+        if self.frame is not None:
+            raise VirtualMachineError("join() while guest code is running")
+        queue = self.tasks
+        waiting = set(id(task) for task in tasks if not task.done)
+        try:
+            while queue and (waiting or not tasks):
+                task = queue.popleft()
+                self._run_task(task, self.task_slice)
+                if task.done:
+                    waiting.discard(id(task))
+                else:
+                    queue.append(task)
+        finally:
+            self.frames = []
+            self.frame = None
+            self.last_exception = None
+            self.exc_info = (None, None, None)
+
+    def _run_task(self, task, budget, await_calls=False):
+        """Give `task` a turn of `budget` instructions."""
+        if self.frame is not None:
+            raise VirtualMachineError("a task can't run inside guest code")
+        if task.frame is None:
+            self.frames = []
+            self.push_frame(task.root)
+        else:
+            self.frames = task.frames
+            self.frame = task.frame
+        self.last_exception = task.last_exception
+        self.exc_info = task.exc_info
+        why = None
+        if task.pending is not None:
+            # raised by what the task was waiting for
+            exc, task.pending = task.pending, None
+            self.last_exception = (type(exc), exc, Traceback(self.frame))
+            why = self.handle_why(WHY_EXCEPTION)
             if why:
-                break
-        self.pop_frame()
-        if why == 'exception':
-            # print>>sys.stderr, self.last_exception
-            # 交给上层frame处理异常
-            six.reraise(*self.last_exception)
+                why = self.leave_frame(task.root, why)
+        if not why:
+            self.await_calls = await_calls
+            try:
+                if self.tracer is None and self.profiler is None:
+                    why = self._run_counted(task.root, budget)
+                else:
+                    why = self._run_traced(task.root, self.tracer,
+                                           self.profiler, budget)
+            finally:
+                self.await_calls = False
+
+        if why == WHY_SUSPEND or why == WHY_AWAIT:
+            if why == WHY_AWAIT:
+                task.awaiting = self.return_value
+            task.frames = self.frames
+            task.frame = self.frame
+            task.last_exception = self.last_exception
+            task.exc_info = self.exc_info
+        else:
+            self.pop_frame()
+            if why == WHY_EXCEPTION:
+                exctype, task.exception, task.traceback = self.last_exception
+            else:
+                task.result = self.return_value
+            task.done = True
+            task.frames = task.frame = task.last_exception = None
+            task.exc_info = None
+        self.frames = []
+        self.frame = None
+        self.last_exception = None
+        self.exc_info = (None, None, None)
 
-        return self.return_value
+    def _run_counted(self, entry, budget):
+        """Like `_run_fast`, but carrying on from the current frame and
+        returning WHY_SUSPEND once `budget` instructions have run.
+
+        """
+        frame = self.frame
+        instrs = frame.instrs
+        while True:
+            try:
+                while budget:
+                    bytecode_fn, arguments, frame.f_lasti = instrs[frame.f_lasti]
+                    budget -= 1
+                    why = bytecode_fn(self, *arguments)
+                    if why:
+                        break
+                else:
+                    self.budget_left = 0
+                    return WHY_SUSPEND
+            except:
+                if not CATCH:
+                    raise
+                why = self.catch_exception()
+            if why == WHY_AWAIT:
+                self.budget_left = budget
+                return why
+            if why != WHY_CALL:
+                why = self.handle_why(why)
+                if why:
+                    why = self.leave_frame(entry, why)
+                    if why:
+                        self.budget_left = budget
+                        return why
+            frame = self.frame
+            instrs = frame.instrs
+
+    def _run_fast(self, entry):
+        frame = entry
+        instrs = frame.instrs
+        while True:
+            # handlers run without a try block of their own: the loop is only
+            # left when one returns a why or an exception propagates
+            try:
+                while True:
+                    bytecode_fn, arguments, frame.f_lasti = instrs[frame.f_lasti]
+                    why = bytecode_fn(self, *arguments)
+                    if why:
+                        break
+            except:
+                if not CATCH:
+                    raise
+                why = self.catch_exception()
+            if why != WHY_CALL:
+                why = self.handle_why(why)
+                if why:
+                    why = self.leave_frame(entry, why)
+                    if why:
+                        return why
+            frame = self.frame
+            instrs = frame.instrs
+
+    def _run_traced(self, entry, tracer, profiler, budget=-1):
+        frame = self.frame
+        instrs = frame.instrs
+        if profiler is not None:
+            timer = profiler.timer
+        while True:
+            try:
+                while True:
+                    if not budget:
+                        self.budget_left = 0
+                        return WHY_SUSPEND
+                    budget -= 1
+                    offset = frame.f_lasti
+                    bytecode_fn, arguments, frame.f_lasti = instrs[offset]
+                    if tracer is not None:
+                        tracer(frame, offset, bytecode_fn.__name__, arguments)
+                    if profiler is None:
+                        why = bytecode_fn(self, *arguments)
+                    else:
+                        start = timer()
+                        try:
+                            why = bytecode_fn(self, *arguments)
+                        finally:
+                            profiler.record(frame.f_code, offset,
+                                            bytecode_fn.__name__,
+                                            timer() - start)
+                    if why:
+                        break
+            except:
+                if not CATCH:
+                    raise
+                why = self.catch_exception()
+            if why == WHY_AWAIT:
+                self.budget_left = budget
+                return why
+            if why != WHY_CALL:
+                why = self.handle_why(why)
+                if why:
+                    why = self.leave_frame(entry, why)
+                    if why:
+                        self.budget_left = budget
+                        return why
+            frame = self.frame
+            instrs = frame.instrs
+
+    def catch_exception(self):
+        """Record the host exception being handled as raised by the current
+        instruction, and return the why to unwind with.
+
+        """
+        exctype, val = sys.exc_info()[:2]
+        tb = None
+        if self.last_exception is not None and self.last_exception[1] is val:
+            # raised by guest code under a nested run_frame
+            tb = self.last_exception[2]
+        self.last_exception = (exctype, val, Traceback(self.frame, tb))
+        return WHY_EXCEPTION
+
+    def leave_frame(self, entry, why):
+        """The current frame has stopped with `why`.
+
+        Frames called inline above `entry` are popped, handing their return
+        value or exception to the caller.  Returns None when some caller
+        carries on running, or the why of `entry` itself.
+
+        """
+        while self.frame is not entry:
+            frame = self.frame
+            self.pop_frame()
+            if why == WHY_RETURN:
+                self.frame.stack.append(self.return_value)
+                self.release_frame(frame)
+                return None
+            exctype, val, tb = self.last_exception
+            self.last_exception = (exctype, val, Traceback(self.frame, tb))
+            why = self.handle_why(why)
+            if not why:
+                return None
+        return why
+
+    def handle_why(self, why):
+        """Act on the `why` returned by a bytecode.
+
+        Returns None when execution continues in the current frame.
+
+        """
+        if why == WHY_RERAISE:
+            why = WHY_EXCEPTION
+
+        if why != WHY_YIELD and self.frame.block_stack:
+            why = self.manage_block_stack(why)
+        return why
 
     def push_block(self, type, handler=None, level=None):
         if level is None:
@@ -220,164 +1781,230 @@ class VirtualMachine(object):
 
    
     def manage_block_stack(self, why):
-        logging.info("enter manager")
+        """Unwind the block stack of the current frame for `why`.
 
-        block = self.frame.block_stack[-1]
-        if block.type == 'loop' and why == 'continue':
-            self.frame.f_lasti = self.return_value 
-            why = None
-            return why
-            
-        block = self.pop_block()
-        if block.type == 'loop' and why == 'break':
-            logging.info("for  loop break")
-            why = None
-            self.frame.f_lasti = block.handler 
-            return why
+        Blocks that don't handle `why` are popped along with whatever they
+        left on the value stack.  Returns None once a block takes over,
+        otherwise `why` after the frame's blocks are all gone.
 
-        if block.type == 'except':
-            if why == 'exception':
-                logging.info("for  excepting")
-                exctype, value, tb = self.last_exception
-                self.push(tb, value, exctype)
-                why = None
-                self.frame.f_lasti = block.handler 
-                return why
-            if why == 'continue':
-                self.frame.f_lasti = self.return_value 
-                why = None
-                return why
-
-        if block.type == 'finally':
-            if why == 'exception':
+        """
+        frame = self.frame
+        block_stack = frame.block_stack
+        while block_stack:
+            block = block_stack[-1]
+            if block.type == 'loop' and why == WHY_CONTINUE:
+                frame.f_lasti = self.return_value
+                return None
+
+            block_stack.pop()
+            if block.type == 'except-handler':
+                self.unwind_except_handler(block)
+                continue
+            del frame.stack[block.level:]
+            if block.type == 'loop' and why == WHY_BREAK:
+                frame.f_lasti = block.handler
+                return None
+
+            if why == WHY_EXCEPTION and block.type in ('except', 'finally'):
                 exctype, value, tb = self.last_exception
+                if PY3:
+                    # the handler runs with this as the exception being
+                    # handled; the previous one is kept underneath
+                    block_stack.append(Block('except-handler', None,
+                                             len(frame.stack)))
+                    old_type, old_value, old_tb = self.exc_info
+                    self.push(old_tb, old_value, old_type)
+                    self.exc_info = self.last_exception
                 self.push(tb, value, exctype)
-            if why == 'continue':
-                self.push(self.return_value)
-                self.push(why)
-            why = None
-            self.frame.f_lasti = block.handler 
-            return why
+                frame.f_lasti = block.handler
+                return None
 
+            if block.type == 'except' and why == WHY_CONTINUE:
+                frame.f_lasti = self.return_value
+                return None
 
-    def parse_byte(self):
-        f = self.frame
-        opoffset = f.f_lasti
-        byteCode = ord(f.f_code.co_code[opoffset])
-        f.f_lasti += 1
-        byteName = dis.opname[byteCode]
-        arg = None
-        arguments = []
-        if byteCode >= dis.HAVE_ARGUMENT:
-            arg = f.f_code.co_code[f.f_lasti:f.f_lasti+2]
-            f.f_lasti += 2
-            intArg = ord(arg[0]) + (ord(arg[1]) << 8)
-            if byteCode in dis.hasconst:
-                arg = f.f_code.co_consts[intArg]
-            elif byteCode in dis.hasfree:
-                if intArg < len(f.f_code.co_cellvars):
-                    arg = f.f_code.co_cellvars[intArg]
-                else:
-                    var_idx = intArg - len(f.f_code.co_cellvars)
-                    arg = f.f_code.co_freevars[var_idx]
-            elif byteCode in dis.hasname:
-                arg = f.f_code.co_names[intArg]
-            elif byteCode in dis.hasjrel:
-                arg = f.f_lasti + intArg
-            elif byteCode in dis.hasjabs:
-                arg = intArg
-            elif byteCode in dis.haslocal:
-                arg = f.f_code.co_varnames[intArg]
-            else:
-                arg = intArg
-            arguments = [arg]
-
-        return byteName, arguments, opoffset
-
+            if block.type == 'finally':
+                if why == WHY_RETURN or why == WHY_CONTINUE:
+                    self.push(self.return_value)
+                self.push(why)
+                frame.f_lasti = block.handler
+                return None
+        return why
 
-    def dispatch(self, byteName, arguments):
-        logging.info(byteName + " " + str(arguments) + '\n')
+    def unwind_except_handler(self, block):
+        """Drop what an except handler left on the stack and go back to
+        handling the exception that was being handled before it.
 
-        byteName = byteName.replace('+','')
-        why = None
-        if CATCH:
-            try:
-                bytecode_fn = getattr(self,  byteName, None)
-                if not bytecode_fn:            
-                    raise VirtualMachineError(
-                        "unknown bytecode type: %s" % byteName
-                    )
-                why = bytecode_fn(*arguments)
-            except:
-                self.last_exception = sys.exc_info()[:2] + (None,)
-                why = 'exception'
-        else:
-            bytecode_fn = getattr(self,  byteName, None)
-            if not bytecode_fn:            
-                raise VirtualMachineError(
-                    "unknown bytecode type: %s" % byteName
-                )
-            why = bytecode_fn(*arguments)
+        """
+        stack = self.frame.stack
+        del stack[block.level + 3:]
+        exctype = stack.pop()
+        value = stack.pop()
+        tb = stack.pop()
+        self.exc_info = (exctype, value, tb)
 
-        return why
+    @classmethod
+    def _build_dispatch_table(cls):
+        """Build the opcode-indexed handler table shared by all instances.
 
-    def _get_exec(self, code):
-        self.frame.byte_to_instr = {}
-        what_to_exec = {
-                "instructions":[],
-                "constants": code.co_consts,
-                "names": code.co_names,
-                }
+        Opcodes without a handler get a stub raising VirtualMachineError and
+        are listed in `unknown_opcodes`, so they show up here rather than
+        the first time guest code runs them.
 
-        byte_codes = [ord(c) for c in code.co_code]
-        
-        i = j = 0
-        while i < len(byte_codes):
-            self.frame.byte_to_instr[i] = j
-            byte_code = byte_codes[i]
-            name = dis.opname[byte_code]
-            if byte_code >= self.HAVE_ARGUMENT:
-                arg = (byte_codes[i+2] << 8) + byte_codes[i+1]
-                i += 2
+        """
+        table = []
+        unknown = []
+        for byteName in dis.opname:
+            byteName = byteName.replace('+', '')
+            handler = getattr(cls, byteName, None)
+            if handler is None:
+                # EXTENDED_ARG is folded into the next instruction by decode_code
+                if byteName[0] != '<' and byteName != 'EXTENDED_ARG':
+                    unknown.append(byteName)
+                handler = _unknown_bytecode(byteName)
             else:
-                arg = None
-            what_to_exec["instructions"].append((dis.opname[byte_code], arg))
-            i += 1
-            j += 1
-
-        self.frame.instr_to_byte = dict(zip(self.frame.byte_to_instr.values(),
-                                      self.frame.byte_to_instr.keys()))
-        return what_to_exec
+                handler = six.get_unbound_function(handler)
+            table.append(handler)
+        if unknown:
+            logging.warning("%s has no handler for: %s",
+                            cls.__name__, ", ".join(unknown))
+        cls.unknown_opcodes = frozenset(unknown)
+        cls._dispatch_table = table
+        # (superinstructions, optimize) -> code object -> instruction
+        # stream, see `decode`
+        cls._decoded = {}
+
+    def decode(self, code):
+        """Return the decoded instruction stream for `code`.
+
+        The stream is a list indexed by byte offset; each instruction start
+        holds a `(handler, arguments, next_offset)` entry.  Decoding happens
+        once per code object and is shared by every VM of the same class.
+
+        With `self.optimize` the stream goes through `optimize_stream`.
+        With `self.superinstructions` it has common sequences fused into
+        one handler (see `fuse_superinstructions`) and, for Python 2,
+        method calls paired up (see `pair_method_calls`).  Neither applies
+        when a tracer or profiler is attached: those see every instruction.
+        With `self.stream_cache` the streams are also kept on disk.
 
-    
-    def _parse_argument(self, instr, arg, what_to_exec):
-        if arg is None:
-            return nil
-        byte_code = dis.opmap[instr]
-        if byte_code in dis.hasconst:
-            return what_to_exec['constants'][arg]
-        elif byte_code in dis.hasname:
-            return what_to_exec['names'][arg]
+        """
+        if self.tracer or self.profiler:
+            passes = (False, False)
         else:
-            return arg
-
-    def make_frame(self, code, callargs={}, f_globals=None, f_locals=None):
+            passes = (self.superinstructions, self.optimize)
+        try:
+            cache = self._decoded[passes]
+        except KeyError:
+            cache = self._decoded[passes] = weakref.WeakKeyDictionary()
+        try:
+            return cache[code]
+        except KeyError:
+            pass
+
+        stream_cache = self.stream_cache
+        if stream_cache is None:
+            instrs = cache[code] = self._build_stream(code, passes)
+            return instrs
+
+        key = stream_cache.key(code, type(self), passes)
+        streams = stream_cache.load(key, code, type(self))
+        if streams is None:
+            streams = []
+            for path, nested in _nested_code(code):
+                instrs = cache.get(nested)
+                if instrs is None:
+                    instrs = self._build_stream(nested, passes)
+                streams.append((nested, instrs))
+            stream_cache.store(key, streams)
+        for nested, instrs in streams:
+            if nested not in cache:
+                cache[nested] = instrs
+        return cache[code]
+
+    def _build_stream(self, code, passes):
+        instrs = decode_code(code, self._dispatch_table)
+        superinstructions, optimize = passes
+        if optimize:
+            instrs = optimize_stream(instrs, type(self))
+        if superinstructions:
+            if PY2:
+                instrs = pair_method_calls(instrs, type(self))
+            instrs = fuse_superinstructions(instrs, type(self))
+        return instrs
+
+    def _module_globals(self):
+        return VersionedDict({
+            '__builtins__': __builtins__,
+            '__name__': '__main__',
+            '__doc__': None,
+            '__package__': None,
+        })
+
+    def make_frame(self, code, callargs={}, f_globals=None, f_locals=None,
+                   fastlocals=None, closure=None):
         if f_globals is not None:
             f_globals = f_globals
             if f_locals is None:
                 f_locals = f_globals
         elif self.frames:
             f_globals = self.frame.f_globals
-            self.local_env = f_locals = {}
+            f_locals = {}
         else:
-            self.env = f_globals = f_locals = {
-                '__builtins__': __builtins__,
-                '__name__': '__main__',
-                '__doc__': None,
-                '__package__': None,
-            }
+            self.env = f_globals = f_locals = self._module_globals()
         f_locals.update(callargs)
-        frame = Frame(code, f_globals, f_locals, self.frame)
+        frame = Frame(code, f_globals, f_locals, self.frame, fastlocals,
+                      self.builtins, closure)
+        frame.instrs = self.decode(code)
+        return frame
+
+    # how many returned frames to keep for reuse per code object
+    frame_pool_size = 4
+
+    # how many instructions a task runs before the next one gets a turn
+    task_slice = 1000
+
+    def release_frame(self, frame):
+        """Keep `frame`, which has returned, for a later call of its code.
+
+        Only plain function frames nothing else can see are kept: not
+        generator frames, not frames with cells, not frames that showed up
+        in a traceback or gave out their locals, and not while a tracer or
+        profiler (which get to see frames) is attached.
+
+        """
+        if (frame.escaped or frame.generator is not None or
+                frame.fastlocals is None or frame.cells is not None or
+                self.tracer is not None or self.profiler is not None):
+            return
+        pool = self._frame_pool.get(frame.f_code)
+        if pool is None:
+            pool = self._frame_pool[frame.f_code] = []
+        elif len(pool) >= self.frame_pool_size:
+            return
+        # a return from inside a loop or try block leaves things behind
+        if frame.stack:
+            del frame.stack[:]
+        if frame.block_stack:
+            del frame.block_stack[:]
+        if frame._f_locals:
+            frame._f_locals.clear()
+        frame.f_back = frame.fastlocals = None
+        pool.append(frame)
+
+    def reuse_frame(self, code, f_globals, fastlocals):
+        """A released frame for `code` set up to run with `fastlocals`, or
+        None if there is none.
+
+        """
+        pool = self._frame_pool.get(code)
+        if not pool:
+            return None
+        frame = pool.pop()
+        frame.f_globals = f_globals
+        frame.f_back = self.frame
+        frame.fastlocals = fastlocals
+        frame.f_lasti = 0
         return frame
 
     def push_frame(self, frame):
@@ -409,8 +2036,9 @@ class VirtualMachine(object):
 
         """
         if n:
-            ret = self.frame.stack[-n:]
-            self.frame.stack[-n:] = []
+            stack = self.frame.stack
+            ret = stack[-n:]
+            del stack[-n:]
             return ret
         else:
             return []
@@ -423,48 +2051,93 @@ class VirtualMachine(object):
     def LOAD_CONST(self, const):
         self.push(const)
 
-    def LOAD_NAME(self, name):
+    # LOAD_NAME and LOAD_GLOBAL cache what they resolved in the globals'
+    # `sites` table as (globals version, value, builtins).  `builtins` is
+    # None for names found in the globals; for names found in the builtins,
+    # which are not versioned, it is the builtins dict and the hit also
+    # checks that the name still maps to the cached value there.
+
+    def _cached_global(self, frame, f_globals, name, site):
+        try:
+            entry = f_globals.sites.get(site)
+        except AttributeError:
+            return nil
+        if entry is not None and entry[0] == f_globals.version:
+            val = entry[1]
+            builtins = entry[2]
+            if builtins is None or builtins.get(name, nil) is val:
+                return val
+        return nil
+
+    def _resolve_global(self, frame, f_globals, name, site):
+        if name in f_globals:
+            val = f_globals[name]
+            builtins = None
+        else:
+            builtins = frame.f_builtins
+            val = builtins.get(name, nil)
+            if val is nil:
+                return nil
+        try:
+            f_globals.sites[site] = (f_globals.version, val, builtins)
+        except AttributeError:
+            pass
+        return val
+
+    def LOAD_NAME(self, name, site):
         frame = self.frame
-        if name in frame.f_locals:
-            val = frame.f_locals[name]
-        elif name in frame.f_globals:
-            val = frame.f_globals[name]
-        elif name in frame.f_builtins:
-            val = frame.f_builtins[name]
+        f_locals = frame._f_locals
+        f_globals = frame.f_globals
+        if f_locals is f_globals:
+            val = self._cached_global(frame, f_globals, name, site)
+            if val is nil:
+                val = self._resolve_global(frame, f_globals, name, site)
+        elif name in f_locals:
+            val = f_locals[name]
+        elif name in f_globals:
+            val = f_globals[name]
         else:
+            val = frame.f_builtins.get(name, nil)
+        if val is nil:
             raise NameError("name '%s' is not defined" % name)
-        self.push(val)
+        frame.stack.append(val)
         
 
     def STORE_NAME(self, name):
-        self.frame.f_locals[name] = self.pop()
+        self.frame._f_locals[name] = self.pop()
 
-    def LOAD_FAST(self, name):
-        #name = self.frame.f_code.co_varnames[name]
-        if name in self.frame.f_locals:
-            val = self.frame.f_locals[name]
-        else:
+    def LOAD_FAST(self, index):
+        frame = self.frame
+        val = frame.fastlocals[index]
+        if val is nil:
             raise UnboundLocalError(
-                "local variable '%s' referenced before assignment" % name
+                "local variable '%s' referenced before assignment" %
+                frame.f_code.co_varnames[index]
             )
-        self.push(val)
-        
+        frame.stack.append(val)
 
-    def STORE_FAST(self, name):
-        self.frame.f_locals[name] = self.pop()
+    def STORE_FAST(self, index):
+        frame = self.frame
+        frame.fastlocals[index] = frame.stack.pop()
 
-    def DELETE_FAST(self, name):
-        del self.frame.f_locals[name]
+    def DELETE_FAST(self, index):
+        frame = self.frame
+        if frame.fastlocals[index] is nil:
+            raise UnboundLocalError(
+                "local variable '%s' referenced before assignment" %
+                frame.f_code.co_varnames[index]
+            )
+        frame.fastlocals[index] = nil
 
-    def LOAD_GLOBAL(self, name):
+    def LOAD_GLOBAL(self, name, site):
         f = self.frame
-        if name in f.f_globals:
-            val = f.f_globals[name]
-        elif name in f.f_builtins:
-            val = f.f_builtins[name]
-        else:
-            raise NameError("global name '%s' is not defined" % name)
-        self.push(val)
+        f_globals = f.f_globals
+        val = self._cached_global(f, f_globals, name, site)
+        if val is nil:
+            val = self._resolve_global(f, f_globals, name, site)
+            if val is nil:
+                raise NameError(_GLOBAL_NAME_ERROR % name)
+        f.stack.append(val)
 
    
     def STORE_GLOBAL(self, name):
@@ -473,14 +2146,45 @@ class VirtualMachine(object):
     def DELETE_GLOBAL(self, name):
         del self.frame.f_globals[name]
 
-    def LOAD_CLOSURE(self, name):
-        self.push(self.frame.cells[name])
+    def LOAD_CLOSURE(self, index):
+        frame = self.frame
+        frame.stack.append(frame.cells[index])
 
-    def LOAD_DEREF(self, name):
-        self.push(self.frame.cells[name])
+    def LOAD_DEREF(self, index):
+        frame = self.frame
+        val = frame.cells[index].cell_contents
+        if val is nil:
+            code = frame.f_code
+            if index < len(code.co_cellvars):
+                raise UnboundLocalError(
+                    "local variable '%s' referenced before assignment" %
+                    code.co_cellvars[index])
+            raise NameError(
+                "free variable '%s' referenced before assignment in "
+                "enclosing scope" %
+                code.co_freevars[index - len(code.co_cellvars)])
+        frame.stack.append(val)
+
+    def STORE_DEREF(self, index):
+        frame = self.frame
+        frame.cells[index].cell_contents = frame.stack.pop()
+
+    def DELETE_DEREF(self, index):
+        frame = self.frame
+        cell = frame.cells[index]
+        if cell.cell_contents is nil:
+            self.LOAD_DEREF(index)
+        cell.cell_contents = nil
 
-    def STORE_DEREF(self, name):
-        self.frame.cells[name] = self.pop()
+    def LOAD_CLASSDEREF(self, index):
+        # a class body sees its own names before the enclosing function's
+        frame = self.frame
+        code = frame.f_code
+        name = (code.co_cellvars + code.co_freevars)[index]
+        if name in frame._f_locals:
+            frame.stack.append(frame._f_locals[name])
+        else:
+            self.LOAD_DEREF(index)
 
     def LOAD_ATTR(self, name):
         target = self.pop()
@@ -526,7 +2230,7 @@ class VirtualMachine(object):
 
     def BINARY_MULTIPLY(self):
         v1, v2 = self.popn(2)
-        self.push(v2 * v1)
+        self.push(v1 * v2)
 
     def BINARY_DIVIDE(self):
         v1, v2 = self.popn(2)
@@ -534,7 +2238,19 @@ class VirtualMachine(object):
 
     def BINARY_POWER(self):
         v1, v2 = self.popn(2)
-        self.push(v2 ** v1)
+        self.push(v1 ** v2)
+
+    def BINARY_TRUE_DIVIDE(self):
+        v1, v2 = self.popn(2)
+        self.push(operator.truediv(v1, v2))
+
+    def BINARY_FLOOR_DIVIDE(self):
+        v1, v2 = self.popn(2)
+        self.push(v1 // v2)
+
+    def BINARY_MATRIX_MULTIPLY(self):
+        v1, v2 = self.popn(2)
+        self.push(operator.matmul(v1, v2))
 
     def BINARY_MODULO(self):
         v1, v2 = self.popn(2)
@@ -566,32 +2282,78 @@ class VirtualMachine(object):
 
 
     def PRINT_EXPR(self):
-        print self.pop()
+        sys.displayhook(self.pop())
+
+    # the Python 2 print statement, softspace and all
+
+    def _print_item(self, item, to):
+        if to is None:
+            to = sys.stdout
+        if getattr(to, 'softspace', 0):
+            to.write(' ')
+        if isinstance(item, six.string_types):
+            to.write(item)
+            softspace = not (item and item[-1].isspace() and item[-1] != ' ')
+        else:
+            to.write(str(item))
+            softspace = 1
+        try:
+            to.softspace = softspace
+        except AttributeError:
+            pass
+
+    def _print_newline(self, to):
+        if to is None:
+            to = sys.stdout
+        to.write('\n')
+        try:
+            to.softspace = 0
+        except AttributeError:
+            pass
 
     def PRINT_ITEM(self):
-        print self.pop(),
+        self._print_item(self.pop(), None)
 
     def PRINT_ITEM_TO(self):
         to = self.pop()
         item = self.pop()
-        print>>to, item,
+        self._print_item(item, to)
 
     def PRINT_NEWLINE(self):
-        print
+        self._print_newline(None)
 
     def PRINT_NEWLINE_TO(self):
-        to = self.pop()
-        print>>to
+        self._print_newline(self.pop())
 
     def RETURN_VALUE(self):
         self.return_value =  self.pop()
         if self.frame.generator:
             self.frame.generator.finished = True
-        return 'return'
+        return WHY_RETURN
 
     def YIELD_VALUE(self):
         self.return_value = self.pop()
-        return "yield"
+        return WHY_YIELD
+
+    def GET_YIELD_FROM_ITER(self):
+        self.push(iter(self.pop()))
+
+    def YIELD_FROM(self):
+        value = self.pop()
+        stack = self.frame.stack
+        it = stack[-1]
+        try:
+            if value is None or not hasattr(it, 'send'):
+                value = next(it)
+            else:
+                value = it.send(value)
+        except StopIteration as e:
+            stack[-1] = e.value
+            return
+        # yield what the subiterator gave and come back here when resumed
+        self.return_value = value
+        self.frame.f_lasti -= 2
+        return WHY_YIELD
 
     COMPARE_OPERATORS = [
         operator.lt,
@@ -604,7 +2366,7 @@ class VirtualMachine(object):
         lambda x, y: x not in y,
         lambda x, y: x is y,
         lambda x, y: x is not y,
-        lambda x, y: issubclass(x, Exception) and issubclass(x, y),
+        lambda x, y: issubclass(x, y),
     ]
 
     def COMPARE_OP(self, opnum):
@@ -651,26 +2413,31 @@ class VirtualMachine(object):
     def FOR_ITER(self, step):
         v = self.frame.stack[-1]
         try:
-            self.push(v.next())
+            self.push(next(v))
         except StopIteration:
             self.pop()
             self.frame.f_lasti = step
 
     def SETUP_LOOP(self, dest):
-        self.push_block('loop', dest)
+        frame = self.frame
+        frame.block_stack.append(Block('loop', dest, len(frame.stack)))
 
     def SETUP_EXCEPT(self, dest):
-        self.push_block('except', dest)
+        frame = self.frame
+        frame.block_stack.append(Block('except', dest, len(frame.stack)))
 
     def SETUP_FINALLY(self, dest):
         self.push_block('finally', dest)
 
     def END_FINALLY(self):
         v = self.pop()
-        if isinstance(v, str):
+        if type(v) is int:
             why = v
-            if why == 'continue':
+            if why == WHY_RETURN or why == WHY_CONTINUE:
                 self.return_value = self.pop()
+            elif why == WHY_SILENCED:
+                self.unwind_except_handler(self.frame.block_stack.pop())
+                why = None
         elif v is None:
             why = None
         elif issubclass(v, BaseException):
@@ -678,47 +2445,134 @@ class VirtualMachine(object):
             val = self.pop()
             tb = self.pop()
             self.last_exception = (exctype, val, tb)
-            why = 'reraise'
+            why = WHY_RERAISE
         return why
 
     def SETUP_WITH(self, dest):
         ctxmgr = self.pop()
         self.push(ctxmgr.__exit__)
         ctxmgr_obj = ctxmgr.__enter__()
+        # the block keeps __exit__ on the stack for WITH_CLEANUP
+        self.push_block('finally', dest)
         self.push(ctxmgr_obj)
-        self.push_block('with', dest)
 
-    def WITH_CLEANUP(self):
-        v = w = None
-        u = self.peek(1)
+    def _pop_exit(self):
+        """Take the __exit__ of a with block from under what its finally
+        handler got, returning it and the exception (or None) to pass it.
+
+        """
+        stack = self.frame.stack
+        u = stack[-1]
         if u is None:
-            exit_func = self.pop(1)
-        exit_ret = exit_func(w, v, u)
+            return stack.pop(-2), (None, None, None)
+        if type(u) is int:
+            if u == WHY_RETURN or u == WHY_CONTINUE:
+                return stack.pop(-3), (None, None, None)
+            return stack.pop(-2), (None, None, None)
+        exc = (u, stack[-2], stack[-3])
+        if PY3:
+            # under the previous exception, see manage_block_stack
+            exit_func = stack.pop(-7)
+            self.frame.block_stack[-1].level -= 1
+        else:
+            exit_func = stack.pop(-4)
+        return exit_func, exc
+
+    def WITH_CLEANUP(self):
+        exit_func, exc = self._pop_exit()
+        if exit_func(*exc) and exc[0] is not None:
+            # swallow the exception: END_FINALLY sees None
+            del self.frame.stack[-2:]
+            self.frame.stack[-1] = None
+
+    def WITH_CLEANUP_START(self):
+        exit_func, exc = self._pop_exit()
+        self.push(exc[0], exit_func(*exc))
+
+    def WITH_CLEANUP_FINISH(self):
+        res = self.pop()
+        u = self.pop()
+        if u is not None and res:
+            self.push(WHY_SILENCED)
+
+    def POP_EXCEPT(self):
+        block = self.frame.block_stack.pop()
+        if block.type != 'except-handler':
+            raise VirtualMachineError("popped block is not an except handler")
+        self.unwind_except_handler(block)
 
     def POP_BLOCK(self):
-        self.pop_block()
+        self.frame.block_stack.pop()
 
     def BREAK_LOOP(self):
-        return 'break'
+        return WHY_BREAK
 
     def CONTINUE_LOOP(self, dest):
         self.return_value = dest
-        return 'continue'
+        return WHY_CONTINUE
 
 
     def BUILD_LIST(self, num):
-        r = []
-        for i in range(num):
-            r.insert(0, self.pop())
-        self.push(r)
+        self.push(self.popn(num))
 
     def BUILD_TUPLE(self, num):
         t = self.popn(num)
         self.push(tuple(t))
 
-    def BUILD_MAP(self, size):
-        # 忽略size
-        self.push({})
+    if PY2:
+        def BUILD_MAP(self, size):
+            # 忽略size
+            self.push({})
+    else:
+        def BUILD_MAP(self, count):
+            items = self.popn(2 * count)
+            self.push(dict(zip(items[::2], items[1::2])))
+
+        def BUILD_CONST_KEY_MAP(self, count):
+            keys = self.pop()
+            self.push(dict(zip(keys, self.popn(count))))
+
+        def BUILD_STRING(self, count):
+            self.push(''.join(self.popn(count)))
+
+        def FORMAT_VALUE(self, flags):
+            spec = self.pop() if flags & 0x04 else ''
+            value = self.pop()
+            conversion = _CONVERSIONS[flags & 0x03]
+            if conversion is not None:
+                value = conversion(value)
+            self.push(format(value, spec))
+
+    def BUILD_TUPLE_UNPACK(self, count):
+        self.push(tuple(itertools.chain.from_iterable(self.popn(count))))
+
+    BUILD_TUPLE_UNPACK_WITH_CALL = BUILD_TUPLE_UNPACK
+
+    def BUILD_LIST_UNPACK(self, count):
+        self.push(list(itertools.chain.from_iterable(self.popn(count))))
+
+    def BUILD_SET_UNPACK(self, count):
+        self.push(set(itertools.chain.from_iterable(self.popn(count))))
+
+    def BUILD_MAP_UNPACK(self, count):
+        result = {}
+        for mapping in self.popn(count):
+            result.update(mapping)
+        self.push(result)
+
+    def BUILD_MAP_UNPACK_WITH_CALL(self, count):
+        # the function being called sits under its positional arguments
+        func = self.peek(count + 2)
+        result = {}
+        for mapping in self.popn(count):
+            for key in mapping:
+                if key in result:
+                    raise TypeError(
+                        "%s() got multiple values for keyword argument '%s'"
+                        % (getattr(func, '__name__', type(func).__name__),
+                           key))
+                result[key] = mapping[key]
+        self.push(result)
 
     def BUILD_SET(self,count):
         elts = self.popn(count)
@@ -728,6 +2582,17 @@ class VirtualMachine(object):
         name, bases, methods = self.popn(3)
         self.push(type(name, bases, methods))
 
+    def LOAD_BUILD_CLASS(self):
+        self.push(self.build_class)
+
+    def SETUP_ANNOTATIONS(self):
+        f_locals = self.frame._f_locals
+        if '__annotations__' not in f_locals:
+            f_locals['__annotations__'] = {}
+
+    def STORE_ANNOTATION(self, name):
+        self.frame._f_locals['__annotations__'][name] = self.pop()
+
 
     def SET_ADD(self, count):
         val = self.pop()
@@ -751,36 +2616,100 @@ class VirtualMachine(object):
         l.append(val)
 
 
-    def MAKE_FUNCTION(self, arg):
-        code_obj = self.pop()
-        defaults = self.popn(arg)
-        fn = Function(code_obj, defaults, None, self)
-        self.push(fn)
-
-    def MAKE_CLOSURE(self, argc):
-        closure, code = self.popn(2)
-        defaults = self.popn(argc)
-        fn = Function(code, defaults, closure, self)
-        self.push(fn)
-
-    def CALL_FUNCTION(self, argc):
-        return self.call_function(argc, [], {})
-
-    def CALL_FUNCTION_VAR(self, argc):
-        args = self.pop()
-        return self.call_function(argc, args, {})
-
-    def CALL_FUNCTION_KW(self, argc):
-        kwargs = self.pop()
-        return self.call_function(argc, [], kwargs)
-
-    def CALL_FUNCTION_VAR_KW(self, argc):
-        args, kwargs = self.popn(2)
-        return self.call_function(argc, args, kwargs)
+    if PY2:
+        def MAKE_FUNCTION(self, arg):
+            code_obj = self.pop()
+            defaults = self.popn(arg)
+            fn = Function(code_obj, defaults, None, self)
+            self.push(fn)
+
+        def MAKE_CLOSURE(self, argc):
+            closure, code = self.popn(2)
+            defaults = self.popn(argc)
+            fn = Function(code, defaults, closure, self)
+            self.push(fn)
+
+        def CALL_FUNCTION(self, argc):
+            return self.call_function(argc, [], {})
+
+        def CALL_FUNCTION_VAR(self, argc):
+            args = self.pop()
+            return self.call_function(argc, args, {})
+
+        def CALL_FUNCTION_KW(self, argc):
+            kwargs = self.pop()
+            return self.call_function(argc, [], kwargs)
+
+        def CALL_FUNCTION_VAR_KW(self, argc):
+            args, kwargs = self.popn(2)
+            return self.call_function(argc, args, kwargs)
+
+    else:
+        def MAKE_FUNCTION(self, flags):
+            qualname = self.pop()
+            code = self.pop()
+            closure = self.pop() if flags & 0x08 else None
+            annotations = self.pop() if flags & 0x04 else None
+            kwdefaults = self.pop() if flags & 0x02 else None
+            defaults = self.pop() if flags & 0x01 else ()
+            fn = Function(code, defaults, closure, self, kwdefaults, qualname)
+            if annotations:
+                fn.__annotations__ = annotations
+            self.push(fn)
+
+        def CALL_FUNCTION(self, argc):
+            posargs = self.popn(argc)
+            return self.do_call(self.pop(), posargs, {})
+
+        def CALL_FUNCTION_KW(self, argc):
+            names = self.pop()
+            posargs = self.popn(argc)
+            npos = argc - len(names)
+            namedargs = dict(zip(names, posargs[npos:]))
+            del posargs[npos:]
+            return self.do_call(self.pop(), posargs, namedargs)
+
+        def CALL_FUNCTION_EX(self, flags):
+            namedargs = self.pop() if flags & 0x01 else {}
+            if type(namedargs) is not dict:
+                namedargs = dict(namedargs)
+            posargs = list(self.pop())
+            return self.do_call(self.pop(), posargs, namedargs)
+
+    # Python 2 code gets these through pair_method_calls
+
+    def LOAD_METHOD(self, name):
+        # a guest function found on the type is called with obj as its
+        # first argument, without making a bound method first
+        stack = self.frame.stack
+        obj = stack.pop()
+        cls = type(obj)
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                meth = klass.__dict__[name]
+                if (type(meth) is Function and
+                        cls.__getattribute__ is _object_getattribute and
+                        name not in getattr(obj, '__dict__', ())):
+                    stack.append(meth)
+                    stack.append(obj)
+                    return
+                break
+        stack.append(nil)
+        stack.append(getattr(obj, name))
+
+    def CALL_METHOD(self, argc):
+        stack = self.frame.stack
+        if stack[-argc - 2] is nil:
+            posargs = self.popn(argc)
+            func = self.pop()
+        else:
+            posargs = self.popn(argc + 1)
+            func = stack[-1]
+        stack.pop()
+        return self.do_call(func, posargs, {})
 
     def call_function(self, argc, args, kwargs):
         kwlen, poslen = divmod(argc, 256)
-        logging.debug("poslen {}, kwlen {}".format(poslen, kwlen))
 
         namedargs = {}
         for i in range(kwlen):
@@ -790,7 +2719,25 @@ class VirtualMachine(object):
         posargs = self.popn(poslen)
         posargs.extend(args)
 
-        func = self.pop()
+        return self.do_call(self.pop(), posargs, namedargs)
+
+    def do_call(self, func, posargs, namedargs):
+        """Call `func` for the current frame.  Guest functions of this VM
+        get a frame of their own, everything else is called directly.
+
+        """
+        if (type(func) is Function and func._vm is self and
+                not func.func_code.co_flags & CO_GENERATOR):
+            if len(self.frames) >= self.recursion_limit:
+                raise RecursionError("maximum recursion depth exceeded")
+            self.push_frame(func.make_call_frame(posargs, namedargs))
+            return WHY_CALL
+        if func is locals and not posargs and not namedargs:
+            # the host builtin would report the interpreter's own locals
+            self.push(self.frame.f_locals)
+            return
+        if PY3 and func is super and not posargs and not namedargs:
+            posargs = self._super_args()
         if hasattr(func, 'im_func'):
             if func.im_self:
                 posargs.insert(0, func.im_self)
@@ -804,12 +2751,80 @@ class VirtualMachine(object):
                     )
                 )
             func = func.im_func
+        if (type(func) is Function and func._vm is self and
+                not func.func_code.co_flags & CO_GENERATOR):
+            if len(self.frames) >= self.recursion_limit:
+                raise RecursionError("maximum recursion depth exceeded")
+            self.push_frame(func.make_call_frame(posargs, namedargs))
+            return WHY_CALL
         r = func(*posargs, **namedargs)
+        if self.await_calls and inspect.isawaitable(r):
+            self.return_value = r
+            return WHY_AWAIT
         self.push(r)
 
+    def _super_args(self):
+        """The arguments a zero-argument super() stands for: the class
+        from the method's __class__ cell and the method's first argument.
+
+        """
+        frame = self.frame
+        code = frame.f_code
+        if not code.co_argcount:
+            raise RuntimeError("super(): no arguments")
+        if '__class__' not in code.co_freevars:
+            raise RuntimeError("super(): __class__ cell not found")
+        ncells = len(code.co_cellvars)
+        cls = frame.cells[ncells + code.co_freevars.index('__class__')]
+        first = code.co_varnames[0]
+        if first in code.co_cellvars:
+            obj = frame.cells[code.co_cellvars.index(first)].cell_contents
+        else:
+            obj = frame.fastlocals[0]
+        if obj is nil:
+            raise RuntimeError("super(): arg[0] deleted")
+        return [cls.cell_contents, obj]
+
+    def build_class(self, func, name, *bases, **kwds):
+        """The guest's __build_class__: run the class body `func` in a
+        fresh namespace and make the class from it.
+
+        """
+        metaclass = kwds.pop('metaclass', None)
+        if metaclass is None:
+            metaclass = type(bases[0]) if bases else type
+        if isinstance(metaclass, type):
+            for base in bases:
+                base_meta = type(base)
+                if issubclass(metaclass, base_meta):
+                    continue
+                if issubclass(base_meta, metaclass):
+                    metaclass = base_meta
+                    continue
+                raise TypeError(
+                    "metaclass conflict: the metaclass of a derived class "
+                    "must be a (non-strict) subclass of the metaclasses of "
+                    "all its bases")
+        prepare = getattr(metaclass, '__prepare__', None)
+        namespace = prepare(name, bases, **kwds) if prepare else {}
+        frame = self.make_frame(func.func_code, f_globals=func.func_globals,
+                                f_locals=namespace, closure=func.func_closure)
+        classcell = self.run_frame(frame)
+        if '__classcell__' in namespace:
+            del namespace['__classcell__']
+        cls = metaclass(name, bases, namespace, **kwds)
+        if type(classcell) is Cell:
+            classcell.cell_contents = cls
+        return cls
+
     def EXEC_STMT(self):
         stmt, globs, locs = self.popn(3)
-        exec(stmt, globs, locs)
+        try:
+            exec(stmt, globs, locs)
+        finally:
+            for d in (globs, locs):
+                if isinstance(d, VersionedDict):
+                    d.touch()
     ## Importing
 
     def IMPORT_NAME(self, name):
@@ -823,7 +2838,7 @@ class VirtualMachine(object):
         mod = self.pop()
         for attr in dir(mod):
             if attr[0] != '_':
-                self.frame.f_locals[attr] = getattr(mod, attr)
+                self.frame._f_locals[attr] = getattr(mod, attr)
 
     def IMPORT_FROM(self, name):
         mod = self.peek(1)
@@ -834,32 +2849,56 @@ class VirtualMachine(object):
         self.pop()
 
     def DUP_TOP(self):
-        self.push(self.peek(1))
+        stack = self.frame.stack
+        stack.append(stack[-1])
+
+    def DUP_TOP_TWO(self):
+        stack = self.frame.stack
+        stack.extend(stack[-2:])
 
     def DUP_TOPX(self, count):
-        items = self.popn(count)
-        for i in [1, 2]:
-            self.push(*items)
+        stack = self.frame.stack
+        stack.extend(stack[-count:])
 
     def ROT_TWO(self):
-        a, b = self.popn(2)
-        self.push(b, a)
+        stack = self.frame.stack
+        stack[-1], stack[-2] = stack[-2], stack[-1]
 
     def ROT_THREE(self):
-        a, b, c = self.popn(3)
-        self.push(c, a, b)
+        stack = self.frame.stack
+        stack.insert(-2, stack.pop())
 
     def ROT_FOUR(self):
-        a, b, c, d = self.popn(4)
-        self.push(d, a, b, c)
+        stack = self.frame.stack
+        stack.insert(-3, stack.pop())
 
     def DELETE_NAME(self, name):
-        del self.frame.f_locals[name]
+        del self.frame._f_locals[name]
     #refactor
     def UNPACK_SEQUENCE(self, count):
         seq = self.pop()
-        for val in reversed(seq):
-            self.push(val)
+        if type(seq) is not tuple and type(seq) is not list:
+            # take no more from an iterator than it takes to find out
+            it = iter(seq)
+            seq = list(itertools.islice(it, count))
+            if len(seq) == count and next(it, nil) is not nil:
+                raise _unpack_error(count, None)
+        if len(seq) != count:
+            raise _unpack_error(count, len(seq) if len(seq) < count else None)
+        self.frame.stack.extend(seq[::-1])
+
+    def UNPACK_EX(self, arg):
+        before, after = arg & 0xFF, arg >> 8
+        seq = list(self.pop())
+        if len(seq) < before + after:
+            raise ValueError(
+                "not enough values to unpack (expected at least %d, got %d)"
+                % (before + after, len(seq)))
+        end = len(seq) - after
+        stack = self.frame.stack
+        stack.extend(reversed(seq[end:]))
+        stack.append(seq[before:end])
+        stack.extend(reversed(seq[:before]))
 
     #inplace operation
     def INPLACE_POWER(self):
@@ -879,6 +2918,14 @@ class VirtualMachine(object):
         v1, v = self.popn(2)
         self.push(v1 / v)
 
+    def INPLACE_TRUE_DIVIDE(self):
+        v1, v = self.popn(2)
+        self.push(operator.truediv(v1, v))
+
+    def INPLACE_MATRIX_MULTIPLY(self):
+        v1, v = self.popn(2)
+        self.push(operator.imatmul(v1, v))
+
     def INPLACE_FLOOR_DIVIDE(self):
         v1, v = self.popn(2)
         self.push(v1 // v)
@@ -993,36 +3040,94 @@ class VirtualMachine(object):
         v, s = self.popn(2)
         del v[s]
 
-    def RAISE_VARARGS(self, argc):
-        exctype = val = tb = None
-        if argc == 0:
-            exctype, val, tb = self.last_exception
-        elif argc == 1:
-            exctype = self.pop()
-        elif argc == 2:
-            val = self.pop()
-            exctype = self.pop()
-        elif argc == 3:
-            tb = self.pop()
-            val = self.pop()
-            exctype = self.pop()
+    if PY2:
+        def RAISE_VARARGS(self, argc):
+            exctype = val = tb = None
+            if argc == 0:
+                exctype, val, tb = self.last_exception
+            elif argc == 1:
+                exctype = self.pop()
+            elif argc == 2:
+                val = self.pop()
+                exctype = self.pop()
+            elif argc == 3:
+                tb = self.pop()
+                val = self.pop()
+                exctype = self.pop()
+
+            if isinstance(exctype, BaseException):
+                val = exctype
+                exctype = type(val)
+
+            if tb:
+                self.last_exception = (exctype, val, tb)
+                return WHY_RERAISE
+            else:
+                self.last_exception = (exctype, val, Traceback(self.frame))
+                return WHY_EXCEPTION
+
+    else:
+        def RAISE_VARARGS(self, argc):
+            if argc == 0:
+                if self.exc_info[0] is None:
+                    raise RuntimeError("No active exception to reraise")
+                self.last_exception = self.exc_info
+                return WHY_RERAISE
+            cause = self.pop() if argc == 2 else None
+            exc = self.pop()
+            if argc == 2:
+                six.raise_from(exc, cause)
+            raise exc
+
+    def NOP(self):
+        pass
 
-        if isinstance(exctype, BaseException):
-            val = exctype
-            exctype = type(val)
+    ## Superinstructions
 
-        self.last_exception = (exctype, val, tb)
-        if tb:
-            return 'reraise'
-        else:
-            return 'exception'
-    
-    def NOP():
-        pass
+    def _load_fast(self, frame, index):
+        val = frame.fastlocals[index]
+        if val is nil:
+            raise UnboundLocalError(
+                "local variable '%s' referenced before assignment" %
+                frame.f_code.co_varnames[index]
+            )
+        return val
+
+    def LOAD_FAST_LOAD_FAST_BINARY_ADD(self, index1, index2):
+        frame = self.frame
+        x = self._load_fast(frame, index1)
+        y = self._load_fast(frame, index2)
+        frame.stack.append(x + y)
+
+    def LOAD_FAST_LOAD_ATTR(self, index, attr):
+        frame = self.frame
+        frame.stack.append(getattr(self._load_fast(frame, index), attr))
+
+    def LOAD_CONST_RETURN_VALUE(self, const):
+        self.return_value = const
+        if self.frame.generator:
+            self.frame.generator.finished = True
+        return WHY_RETURN
+
+    def COMPARE_OP_POP_JUMP_IF_FALSE(self, opnum, target):
+        stack = self.frame.stack
+        y = stack.pop()
+        x = stack.pop()
+        if not self.COMPARE_OPERATORS[opnum](x, y):
+            self.frame.f_lasti = target
+
+    def FOR_ITER_STORE_FAST(self, step, index):
+        frame = self.frame
+        try:
+            frame.fastlocals[index] = next(frame.stack[-1])
+        except StopIteration:
+            frame.stack.pop()
+            frame.f_lasti = step
 
 if __name__ == '__main__':
     import unittest
     import sys
+    import shutil
 
     class FILE(object):
         def __init__(self, s=None):
@@ -1061,32 +3166,294 @@ if __name__ == '__main__':
             self.vm._reset()
             
 
-        def test_get_exec_and_parse_argnment(self):
+        def test_decode(self):
             o = compile('x = 5', '', 'exec')
-            self.vm.frame = self.vm.make_frame(o)
-            what = self.vm._get_exec(o)
-            self.assertEqual(what['names'], ('x',))
-            self.assertEqual(what['constants'],(5, None))
-            self.assertEqual(what['instructions'], 
-                                 [('LOAD_CONST',0), ('STORE_NAME',0), 
-                                  ('LOAD_CONST',1), ('RETURN_VALUE', None)])
-            
-            instr, arg = what['instructions'][0]
-            arg = self.vm._parse_argument(instr, arg, what)
-            self.assertEqual(arg, 5)
-
-            instr, arg = what['instructions'][1]
-            arg = self.vm._parse_argument(instr, arg, what)
-            self.assertEqual(arg, 'x')
-
-            instr, arg = what['instructions'][2]
-            arg = self.vm._parse_argument(instr, arg, what)
-            self.assertEqual(arg, None)
-
-            instr, arg = what['instructions'][3]
-            arg = self.vm._parse_argument(instr, arg, what)
-            self.assertEqual(arg, nil)
-
+            vm = VirtualMachine(superinstructions=False)
+            instrs = vm.decode(o)
+            if WORDCODE:
+                expected = [('LOAD_CONST', (5,), 2), ('STORE_NAME', ('x',), 4),
+                            ('LOAD_CONST', (None,), 6), ('RETURN_VALUE', (), 8)]
+            else:
+                expected = [('LOAD_CONST', (5,), 3), ('STORE_NAME', ('x',), 6),
+                            ('LOAD_CONST', (None,), 9), ('RETURN_VALUE', (), 10)]
+            self.assertEqual([(i[0].__name__, i[1], i[2])
+                              for i in instrs if i is not None], expected)
+            self.assertIs(vm.decode(o), instrs)
+
+
+        def test_tracer(self):
+            trace = []
+            def tracer(frame, offset, byteName, arguments):
+                trace.append((frame.f_code.co_name, offset, byteName))
+            vm = VirtualMachine(tracer)
+            vm.run_code(compile('def f():\n\treturn 1\nf()', 'm', 'exec'))
+            if WORDCODE:
+                # the qualified name is loaded before MAKE_FUNCTION
+                self.assertEqual(trace[:3], [('<module>', 0, 'LOAD_CONST'),
+                                             ('<module>', 2, 'LOAD_CONST'),
+                                             ('<module>', 4, 'MAKE_FUNCTION')])
+                self.assertEqual(trace[-1], ('<module>', 16, 'RETURN_VALUE'))
+            else:
+                self.assertEqual(trace[:3], [('<module>', 0, 'LOAD_CONST'),
+                                             ('<module>', 3, 'MAKE_FUNCTION'),
+                                             ('<module>', 6, 'STORE_NAME')])
+                self.assertEqual(trace[-1], ('<module>', 19, 'RETURN_VALUE'))
+            self.assertIn(('f', 0, 'LOAD_CONST'), trace)
+
+        def test_profiler(self):
+            prof = Profiler()
+            vm = VirtualMachine(profiler=prof)
+            s = 'def add(x, y):\n\treturn x + y\nt = 0\nfor i in range(10):\n\tt = add(t, i)'
+            vm.run_code(compile(s, 'prof', 'exec'))
+            self.assertEqual(vm.env['t'], 45)
+            opcodes = prof.opcode_stats()
+            self.assertEqual(opcodes['BINARY_ADD'][0], 10)
+            self.assertEqual(opcodes['CALL_FUNCTION'][0], 11)
+            stats = prof.get_stats()
+            adds = [i for i in stats['instructions'] if i['opname'] == 'BINARY_ADD']
+            self.assertEqual(len(adds), 1)
+            self.assertEqual((adds[0]['name'], adds[0]['line'], adds[0]['count']),
+                             ('add', 2, 10))
+            out = FILE()
+            prof.print_stats(stream=out)
+            self.assertIn('BINARY_ADD', out.s)
+
+        def test_superinstructions(self):
+            def f(a, b):
+                for i in a:
+                    if i < b:
+                        b = b + i
+                return None
+            names = [i[0].__name__ for i in self.vm.decode(f.__code__) if i]
+            for fused in ['FOR_ITER_STORE_FAST', 'COMPARE_OP_POP_JUMP_IF_FALSE',
+                          'LOAD_FAST_LOAD_FAST_BINARY_ADD',
+                          'LOAD_CONST_RETURN_VALUE']:
+                self.assertIn(fused, names)
+            # the unfused entries stay behind as jump targets
+            self.assertIn('STORE_FAST', names)
+
+            vm = VirtualMachine(superinstructions=False)
+            names = [i[0].__name__ for i in vm.decode(f.__code__) if i]
+            self.assertNotIn('FOR_ITER_STORE_FAST', names)
+
+        def test_tasks(self):
+            src = ("out = []\n"
+                   "for i in range(3):\n"
+                   "    out.append(i)\n"
+                   "    log.append(name)\n")
+            o = compile(src, 'task', 'exec')
+            vm = VirtualMachine()
+            vm.task_slice = 5
+            log = []
+            envs = [{'log': log, 'name': name} for name in 'abc']
+            tasks = [vm.spawn(o, f_globals=env) for env in envs]
+            vm.run_code(compile('def f(x):\n\treturn 1 / x', 'f', 'exec'))
+            good = vm.spawn(vm.env['f'], 2)
+            bad = vm.spawn(vm.env['f'], 0)
+            vm.join(good)
+            self.assertTrue(good.done)
+            self.assertEqual(good.result, 0.5 if not PY2 else 0)
+            vm.join()
+            self.assertEqual([env['out'] for env in envs], [[0, 1, 2]] * 3)
+            # the tasks took turns
+            self.assertNotEqual(log, sorted(log))
+            self.assertEqual(sorted(log), ['a'] * 3 + ['b'] * 3 + ['c'] * 3)
+            self.assertTrue(all(task.done for task in tasks))
+            self.assertIsInstance(bad.exception, ZeroDivisionError)
+            self.assertEqual(bad.traceback.tb_frame.f_code.co_name, 'f')
+            self.assertIs(vm.frame, None)
+            self.assertEqual(len(vm.tasks), 0)
+
+        def test_snapshot(self):
+            setup = ("table = dict((i, i * i) for i in range(100))\n"
+                     "greeting = 'hello'\n"
+                     "def lookup(i):\n"
+                     "    return greeting, table[i]\n")
+            vm = VirtualMachine()
+            snapshot = vm.snapshot(compile(setup, 'setup', 'exec'))
+            request = compile("greeting = 'bye'\n"
+                              "result = lookup(n)\n", 'request', 'exec')
+            first, second = snapshot.clone(), snapshot.clone()
+            first['n'], second['n'] = 3, 4
+            vm.run_code(request, f_globals=first)
+            snapshot.run_code(compile('print(lookup(2))', 'r', 'exec'))
+            vm.run_code(request, f_globals=second)
+            # each run read its own globals, and the snapshot's stayed put
+            self.assertEqual(first['result'], ('bye', 9))
+            self.assertEqual(second['result'], ('bye', 16))
+            self.assertEqual(tmpfile.s, "('hello', 4)\n")
+            self.assertEqual(snapshot.f_globals['greeting'], 'hello')
+            self.assertIs(first['table'], snapshot.f_globals['table'])
+
+        def test_budgets(self):
+            vm = VirtualMachine()
+            forever = compile('while 1:\n    pass', 'forever', 'exec')
+            with self.assertRaises(BudgetExceeded):
+                vm.run_code(forever, max_instructions=5000)
+            self.assertEqual(vm.frames, [])
+            self.assertIs(vm.frame, None)
+            with self.assertRaises(BudgetExceeded):
+                vm.run_code(forever, timeout=0.01)
+            # guest code can't catch its way out, nor hide in host calls
+            src = ("def gen():\n"
+                   "    while 1:\n"
+                   "        yield 1\n"
+                   "while 1:\n"
+                   "    try:\n"
+                   "        list(gen())\n"
+                   "    except Exception:\n"
+                   "        pass\n")
+            with self.assertRaises(BudgetExceeded):
+                vm.run_code(compile(src, 'stubborn', 'exec'),
+                            max_instructions=50000)
+            self.assertEqual(vm.frames, [])
+            # the budget is exact, and the VM is ready for another run
+            f_code = compile('def f(n):\n'
+                             '    while n:\n'
+                             '        n -= 1\n'
+                             '    return "done"', 'f', 'exec')
+            trace = []
+            counter = VirtualMachine(tracer=lambda *args: trace.append(args))
+            counter.run_code(f_code)
+            del trace[:]
+            counter.env['f'](10)
+            used = len(trace)
+            vm = VirtualMachine(superinstructions=False)
+            vm.run_code(f_code)
+            f = vm.env['f']
+            self.assertEqual(f.call_with_budget((10,), max_instructions=used),
+                             'done')
+            with self.assertRaises(BudgetExceeded):
+                f.call_with_budget((10,), max_instructions=used - 1)
+            self.assertEqual(f(3), 'done')
+            self.assertIs(vm.instructions_left, None)
+
+        @unittest.skipIf(PY2, "asyncio needs Python 3")
+        def test_run_code_async(self):
+            import asyncio
+            log = []
+            # host coroutines, kept out of Python 2's sight
+            host = {'asyncio': asyncio, 'log': log}
+            exec("async def fetch(name, delay):\n"
+                 "    log.append('fetch ' + name)\n"
+                 "    await asyncio.sleep(max(delay, 0))\n"
+                 "    if delay < 0:\n"
+                 "        raise KeyError(name)\n"
+                 "    return name.upper()\n"
+                 "async def gather(*coros):\n"
+                 "    return await asyncio.gather(*coros)\n", host)
+            fetch, gather = host['fetch'], host['gather']
+            loop = asyncio.new_event_loop()
+
+            src = ("got = fetch(name, delay)\n"
+                   "log.append('got ' + got)\n"
+                   "try:\n"
+                   "    fetch(name, -1)\n"
+                   "except KeyError as e:\n"
+                   "    log.append('caught ' + e.args[0])\n"
+                   "result = sum(range(100))\n")
+            o = compile(src, 'async', 'exec')
+            vm = VirtualMachine()
+            envs = [{'fetch': fetch, 'log': log, 'name': 'a', 'delay': 0.02},
+                    {'fetch': fetch, 'log': log, 'name': 'b', 'delay': 0}]
+
+            loop.run_until_complete(gather(*[
+                vm.run_code_async(o, quantum=10, f_globals=env)
+                for env in envs]))
+            self.assertEqual([env['result'] for env in envs], [4950] * 2)
+            # b went on while a was waiting
+            self.assertEqual(log, ['fetch a', 'fetch b', 'got B', 'fetch b',
+                                   'caught b', 'got A', 'fetch a', 'caught a'])
+            self.assertIs(vm.frame, None)
+
+            with self.assertRaises(ZeroDivisionError):
+                loop.run_until_complete(
+                    vm.run_code_async(compile('1 / 0', 'x', 'exec')))
+            loop.close()
+
+        def test_stream_cache(self):
+            directory = tempfile.mkdtemp()
+            try:
+                src = ("def f(x):\n"
+                       "    return [abs(x) for i in range(2)]\n"
+                       "print(f(-1))\n")
+                o = compile(src, 'cached', 'exec')
+                vm = VirtualMachine(optimize=True,
+                                    stream_cache=StreamCache(directory))
+                vm.run_code(o)
+                self.assertEqual(len(os.listdir(directory)), 1)
+                stream = [(i[0], i[1][:1], i[2]) for i in vm.decode(o) if i]
+
+                VirtualMachine._decoded.clear()
+                vm = VirtualMachine(optimize=True,
+                                    stream_cache=StreamCache(directory))
+                loaded = vm.decode(o)
+                self.assertEqual([(i[0], i[1][:1], i[2]) for i in loaded if i],
+                                 stream)
+                # the nested function's stream came with it
+                f_code = [c for c in o.co_consts if isinstance(c, types.CodeType)]
+                self.assertIn(f_code[0], VirtualMachine._decoded[True, True])
+                vm.run_code(o)
+                self.assertEqual(tmpfile.s, '[1, 1]\n[1, 1]\n')
+            finally:
+                shutil.rmtree(directory)
+
+        def test_optimizer(self):
+            src = ("def f(x):\n"
+                   "    y = (1 < 2, not 0, 'ab' * 3, 1 / 0)\n"
+                   "    while 1:\n"
+                   "        if x:\n"
+                   "            break\n"
+                   "        else:\n"
+                   "            continue\n"
+                   "    return y\n"
+                   "    x = 5\n")
+            vm = VirtualMachine(superinstructions=False, optimize=True)
+            vm.run_code(compile(src, 'opt', 'exec'))
+            code = vm.env['f'].func_code
+            optimized = [i for i in vm.decode(code) if i]
+            self.assertIs(vm.decode(code), vm.decode(code))
+            consts = [i[1][0] for i in optimized if i[0].__name__ == 'LOAD_CONST']
+            self.assertEqual(consts[:3], [True, True, 'ababab'])
+            self.assertNotIn('BINARY_MULTIPLY', [i[0].__name__ for i in optimized])
+            # 1 / 0 is left to raise when it runs
+            self.assertIn('BINARY_DIVIDE' if PY2 else 'BINARY_TRUE_DIVIDE',
+                          [i[0].__name__ for i in optimized])
+            # the jumps to the loop's start are threaded and the code after
+            # return is gone
+            names = [i[0].__name__ for i in optimized]
+            self.assertNotIn('JUMP_ABSOLUTE', names)
+            self.assertEqual(names.count('STORE_FAST'), 1)
+            self.assertRaises(ZeroDivisionError, vm.env['f'], 1)
+
+        @unittest.skipUnless(PY2, "Python 3 compiles LOAD_METHOD itself")
+        def test_method_calls(self):
+            def f(a, x):
+                return a.m(x.m(1) + 2), (a.m + x)(), a.m(*x), a.m(x=1)
+            names = [i[0].__name__ for i in self.vm.decode(f.__code__) if i]
+            self.assertEqual(names.count('LOAD_METHOD'), 2)
+            self.assertEqual(names.count('CALL_METHOD'), 2)
+            self.assertEqual(names.count('LOAD_ATTR'), 3)
+
+            vm = VirtualMachine(superinstructions=False)
+            names = [i[0].__name__ for i in vm.decode(f.__code__) if i]
+            self.assertNotIn('LOAD_METHOD', names)
+
+        def test_traceback(self):
+            src = ("def f(x):\n"
+                   "    return 1 / x\n"
+                   "def g():\n"
+                   "    return list(map(f, [1, 0]))\n"
+                   "g()\n")
+            o = compile(src, '<tb>', 'exec')
+            vm = VirtualMachine()
+            self.assertRaises(ZeroDivisionError, vm.run_code, o)
+            tb = vm.last_exception[2]
+            entries = []
+            while tb is not None:
+                entries.append((tb.tb_frame.f_code.co_name, tb.tb_lineno))
+                tb = tb.tb_next
+            self.assertEqual(entries, [('<module>', 5), ('g', 4), ('f', 2)])
 
         def test_run_code(self):
             o = compile('4+7+9', '', 'single')
@@ -1096,7 +3463,7 @@ if __name__ == '__main__':
 
 
         def test_variable_and_BINARY_ADD(self):
-            s = 'x=4\ny=5\nprint x+y\n'
+            s = 'x=4\ny=5\nprint(x+y)\n'
             o = compile(s, '', 'exec')
 
             r = self.vm.run_code(o)
@@ -1116,17 +3483,17 @@ if __name__ == '__main__':
                     return 6
                 else:
                     return 6
-            r = self.vm.run_code(f.func_code)
+            r = self.vm.run_code(f.__code__)
             self.assertEqual(r, 6)
             self.vm._reset()
-            r = self.vm.run_code(g.func_code)
+            r = self.vm.run_code(g.__code__)
             self.assertEqual(r, 6)
 
         def test_BUILD_LIST(self):
             def f():
                 return [1,2,3]
 
-            r = self.vm.run_code(f.func_code)
+            r = self.vm.run_code(f.__code__)
             self.assertEqual(r, [1,2,3])
 
 
@@ -1141,7 +3508,7 @@ if __name__ == '__main__':
 
 
         def test_for_loop(self):
-            s = 'x=0\nfor i in [1,2,3]:\n\tx = x + i\n\tprint x'
+            s = 'x=0\nfor i in [1,2,3]:\n\tx = x + i\n\tprint(x)'
             o = compile(s, '', 'exec')
 
             r = self.vm.run_code(o)
@@ -1192,30 +3559,76 @@ r = f(1, 2)
             s = \
 '''
 def f(x, *args, **kwargs):
-    pass
+    return locals()
 
-f(0, 1, 2, 3, test='yes')
+r = f(0, 1, 2, 3, test='yes')
 '''
             o = compile(s, '', 'exec')
             r = self.vm.run_code(o)
-            self.assertEqual(self.vm.local_env['x'], 0)
-            self.assertEqual(self.vm.local_env['args'], (1,2,3))
-            self.assertEqual(self.vm.local_env['kwargs'], {'test': 'yes'})
+            self.assertEqual(self.vm.env['r']['x'], 0)
+            self.assertEqual(self.vm.env['r']['args'], (1,2,3))
+            self.assertEqual(self.vm.env['r']['kwargs'], {'test': 'yes'})
             
 
         def test_function_call_with_default_arg(self):
             s = \
 '''
 def f(x, y=1, z=2):
-    pass
+    return locals()
 f(0)
-f(0, z=9)
+r = f(0, z=9)
 '''
             o = compile(s, '', 'exec')
             r = self.vm.run_code(o)
-            self.assertEqual(self.vm.local_env['x'], 0)
-            self.assertEqual(self.vm.local_env['y'], 1)
-            self.assertEqual(self.vm.local_env['z'], 9)
+            self.assertEqual(self.vm.env['r']['x'], 0)
+            self.assertEqual(self.vm.env['r']['y'], 1)
+            self.assertEqual(self.vm.env['r']['z'], 9)
+
+        def test_deep_recursion(self):
+            s = \
+'''
+def depth(n):
+    if n == 0:
+        return 0
+    return depth(n - 1) + 1
+r = depth(5000)
+'''
+            o = compile(s, '', 'exec')
+            self.vm.run_code(o)
+            self.assertEqual(self.vm.env['r'], 5000)
+
+            o = compile('def f():\n\treturn f()\nf()', '', 'exec')
+            self.assertRaises(RecursionError, self.vm.run_code, o)
+
+        def test_frame_pool(self):
+            s = ('def f(n):\n'
+                 '    for i in range(n):\n'
+                 '        return i\n'
+                 'f(1)\n'
+                 'f(2)\n')
+            vm = VirtualMachine()
+            vm.run_code(compile(s, '', 'exec'))
+            code = vm.env['f'].func_code
+            pool = vm._frame_pool[code]
+            self.assertEqual(len(pool), 1)
+            frame = pool[0]
+            self.assertEqual((frame.stack, frame.block_stack), ([], []))
+            vm.env['f'](3)
+            self.assertEqual(vm._frame_pool[code], [frame])
+
+            # frames seen by a traceback are not reused
+            self.assertRaises(TypeError, vm.env['f'], None)
+            self.assertEqual(vm._frame_pool[code], [])
+
+        def test_code_freed_with_vm(self):
+            import gc
+            s = 'def fib(n):\n\treturn n if n < 2 else fib(n-1) + fib(n-2)\nfib(5)'
+            vm = VirtualMachine()
+            vm.run_code(compile(s, '', 'exec'))
+            code = weakref.ref(vm.env['fib'].func_code)
+            del vm
+            gc.collect()
+            self.assertIsNone(code())
 
         def test_builtin_function(self):
             o = compile('r = len([1,2,3])', '', 'single')
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Batches: many guest programs run on a pool of worker processes.
+
+`run_batch(jobs)` takes (code, env) pairs, where code is a code object or
+source text and env the globals it starts with, and yields a result dict
+for each job as it finishes.  Each worker keeps one VirtualMachine and the
+code it has run, so a job that comes round again is already decoded.
+With `setup` code, the workers start from a Snapshot of the globals it
+leaves, and `run_forked` runs a job in a fork of a process holding one.
+
+Run `python vmbatch.py FILE...` to run scripts and print JSON results.
+
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import marshal
+import multiprocessing
+import os
+import pickle
+import sys
+import timeit
+import types
+
+import six
+
+from vm import VirtualMachine, VirtualMachineError
+
+
+# how many code objects a worker keeps, and with them their decoded streams
+CODE_CACHE_SIZE = 256
+
+# the worker's VirtualMachine, the Snapshot its jobs start from and the code
+# it has run, set by _init_worker.  run_batch makes the snapshot before
+# starting the pool, so that forked workers find it already made.
+_vm = None
+_snapshot = None
+_codes = collections.OrderedDict()
+
+
+def _encode_code(code):
+    """Make `code` something to send to a worker: code objects don't
+    pickle, so they go marshalled."""
+    if isinstance(code, types.CodeType):
+        return 'code', marshal.dumps(code)
+    if isinstance(code, six.string_types):
+        return 'source', code
+    raise TypeError("a job runs a code object or source, not %s"
+                    % type(code).__name__)
+
+
+def _decode_code(kind, data, name):
+    if kind == 'code':
+        return marshal.loads(data)
+    return compile(data, name, "exec")
+
+
+def _encode_job(index, job):
+    code, env = job
+    return (index,) + _encode_code(code) + (env,)
+
+
+def _init_worker(vm_options, setup):
+    global _vm, _snapshot
+    if setup is None:
+        _vm = VirtualMachine(**vm_options)
+        _snapshot = None
+    elif _snapshot is not None:
+        _vm = _snapshot.vm
+    else:
+        # not forked from run_batch's process: set up afresh
+        _vm = VirtualMachine(**vm_options)
+        _snapshot = _vm.snapshot(_decode_code(setup[0], setup[1], "<setup>"))
+    _codes.clear()
+
+
+def _job_code(index, kind, data):
+    """The code object for a job, the same one as last time if the worker
+    has run it before, so that the VM's decode cache finds it."""
+    code = _codes.pop((kind, data), None)
+    if code is None:
+        code = _decode_code(kind, data, "<job %d>" % index)
+        if len(_codes) >= CODE_CACHE_SIZE:
+            _codes.popitem(last=False)
+    _codes[kind, data] = code
+    return code
+
+
+def _picklable(obj):
+    try:
+        pickle.dumps(obj)
+    except Exception:
+        # it has to get back to the parent somehow
+        return repr(obj)
+    return obj
+
+
+def run_job(vm, code, env=None, f_globals=None):
+    """Run `code` as a module on `vm` in `f_globals` (fresh globals by
+    default) updated from `env`, returning (value, exception, stdout) like
+    `vmtest.run_in_vm`.
+
+    """
+    real_stdout = sys.stdout
+    vm_stdout = six.StringIO()
+    sys.stdout = vm_stdout
+
+    if f_globals is None:
+        f_globals = vm._module_globals()
+    if env:
+        f_globals.update(env)
+    vm_value = vm_exc = None
+    try:
+        vm_value = vm.run_frame(vm.make_frame(code, f_globals=f_globals))
+    except Exception as e:
+        vm_exc = e
+        # a VirtualMachineError can leave frames behind; the next job
+        # starts afresh
+        vm._reset()
+    finally:
+        sys.stdout = real_stdout
+    return vm_value, vm_exc, vm_stdout.getvalue()
+
+
+def _run_job(job):
+    index, kind, data, env = job
+    start = timeit.default_timer()
+    try:
+        code = _job_code(index, kind, data)
+    except SyntaxError as e:
+        value, exc, stdout = None, e, ''
+    else:
+        f_globals = _snapshot.clone() if _snapshot is not None else None
+        value, exc, stdout = run_job(_vm, code, env, f_globals)
+    return {
+        'index': index,
+        'value': _picklable(value),
+        'exception': _picklable(exc),
+        'stdout': stdout,
+        'time': timeit.default_timer() - start,
+        'pid': os.getpid(),
+    }
+
+
+def run_batch(jobs, processes=None, chunksize=1, setup=None, **vm_options):
+    """Run `jobs`, (code, env) pairs, on `processes` workers (one per core
+    by default), and yield a result dict for each as it finishes.
+
+    A result has the job's `index` in `jobs`, the `value` and `exception`
+    its code ended with, what it wrote to `stdout`, the `time` it took in
+    seconds and the `pid` of the worker that ran it.  A value or exception
+    that can't be pickled comes back as its repr.  `vm_options` are passed
+    on to each worker's VirtualMachine.
+
+    With `setup` code, every job starts from a clone of a Snapshot of the
+    globals it leaves.  It runs once, here, when the workers are forked
+    from this process, and once per worker otherwise.
+
+    """
+    global _snapshot
+    if setup is not None:
+        setup = _encode_code(setup)
+        start_method = getattr(multiprocessing, 'get_start_method',
+                               lambda: 'fork')()
+        if start_method == 'fork':
+            vm = VirtualMachine(**vm_options)
+            _snapshot = vm.snapshot(_decode_code(setup[0], setup[1],
+                                                 "<setup>"))
+    try:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (vm_options, setup))
+    finally:
+        _snapshot = None
+    try:
+        encoded = (_encode_job(i, job) for i, job in enumerate(jobs))
+        for result in pool.imap_unordered(_run_job, encoded, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_forked(snapshot, code, env=None):
+    """Run `code` like `run_job` on the snapshot's VM, in a child process
+    forked for it, and return what it returns.
+
+    The code runs in the snapshot's globals themselves rather than in a
+    clone: the fork shares them copy-on-write, so whatever the code
+    changes, the snapshot stays as it was.  Needs os.fork.
+
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            value, exc, stdout = run_job(snapshot.vm, code, env,
+                                         snapshot.f_globals)
+            data = pickle.dumps((_picklable(value), _picklable(exc), stdout),
+                                -1)
+            with os.fdopen(write_fd, 'wb') as f:
+                f.write(data)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise VirtualMachineError("the forked run died")
+    return pickle.loads(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="scripts to run")
+    parser.add_argument("-j", "--processes", type=int,
+                        help="how many workers to run (one per core)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="run the optimizer over decoded streams")
+    parser.add_argument("--setup",
+                        help="a script whose globals every file starts with")
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for name in args.files:
+        with open(name) as f:
+            jobs.append((compile(f.read(), name, "exec"), {}))
+    setup = None
+    if args.setup:
+        with open(args.setup) as f:
+            setup = compile(f.read(), args.setup, "exec")
+    failed = False
+    for result in run_batch(jobs, args.processes, setup=setup,
+                            optimize=args.optimize):
+        result['file'] = args.files[result['index']]
+        if result['exception'] is not None:
+            failed = True
+            result['exception'] = repr(result['exception'])
+        result['value'] = repr(result['value'])
+        print(json.dumps(result, sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks: guest workloads timed on the VM and on CPython.
+
+Run `python vmbench.py` for a report, `-o FILE` to save the results as JSON
+and `-c FILE` to compare with an earlier run.  Each workload reads the
+global `N` for its size; BENCHMARKS lists (name, size, test size, source).
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import textwrap
+import timeit
+
+from vm import VirtualMachine
+from vmtest import run_in_vm, run_in_python
+
+
+BENCHMARKS = [
+    ("fib", 20, 10, """\
+        def fib(n):
+            if n < 2:
+                return n
+            return fib(n - 1) + fib(n - 2)
+        print(fib(N))
+        """),
+    ("loop_arith", 100000, 100, """\
+        def loop(n):
+            total = 0
+            i = 0
+            while i < n:
+                total = total + i * 3 % 7 - 1
+                i += 1
+            return total
+        print(loop(N))
+        """),
+    ("comprehensions", 2000, 20, """\
+        def comprehensions(n):
+            squares = [i * i for i in range(n)]
+            evens = {x for x in squares if x % 2 == 0}
+            index = {x: i for i, x in enumerate(squares)}
+            return len(squares), len(evens), len(index)
+        for i in range(10):
+            r = comprehensions(N)
+        print(r)
+        """),
+    ("generators", 20000, 50, """\
+        def count(n):
+            i = 0
+            while i < n:
+                yield i
+                i += 1
+        def pairs(it):
+            for x in it:
+                yield x, x + 1
+        total = 0
+        for a, b in pairs(count(N)):
+            total += a * b
+        print(total)
+        """),
+    ("method_calls", 20000, 50, """\
+        class Point(object):
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+            def add(self, other):
+                return Point(self.x + other.x, self.y + other.y)
+            def norm1(self):
+                return abs(self.x) + abs(self.y)
+        p = Point(0, 0)
+        step = Point(1, -2)
+        for i in range(N):
+            p = p.add(step)
+        print(p.norm1())
+        """),
+    ("try_except", 20000, 50, """\
+        def lookup(d, keys):
+            found = missing = 0
+            for k in keys:
+                try:
+                    d[k]
+                    found += 1
+                except KeyError:
+                    missing += 1
+            return found, missing
+        d = dict((i, i) for i in range(0, N, 2))
+        print(lookup(d, range(N)))
+        """),
+    ("string_building", 20000, 250, """\
+        def build(n):
+            parts = []
+            s = ""
+            for i in range(n):
+                parts.append(str(i))
+                if i % 100 == 0:
+                    s += "%d," % i
+            return len("".join(parts)), len(s)
+        print(build(N))
+        """),
+]
+
+
+class CountingTracer(object):
+    """A tracer that only counts instructions."""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, frame, offset, byteName, arguments):
+        self.count += 1
+
+
+def compile_benchmark(name, n, source):
+    source = "N = %d\n" % n + textwrap.dedent(source)
+    return compile(source, "<bench %s>" % name, "exec", 0, 1)
+
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        fn()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmark(name, n, source, repeat=3):
+    """Time one workload on both interpreters and return its result dict."""
+    code = compile_benchmark(name, n, source)
+
+    vm_result = run_in_vm(code)
+    py_result = run_in_python(code)
+    if vm_result[1] is not None or vm_result[2] != py_result[2]:
+        raise AssertionError("%s: VM and CPython disagree: %r != %r"
+                             % (name, vm_result, py_result))
+
+    vm_time = best_time(lambda: run_in_vm(code), repeat)
+    py_time = best_time(lambda: run_in_python(code), repeat)
+
+    tracer = CountingTracer()
+    run_in_vm(code, VirtualMachine(tracer=tracer))
+
+    return {
+        'name': name,
+        'n': n,
+        'vm_time': vm_time,
+        'py_time': py_time,
+        'slowdown': vm_time / py_time,
+        'instructions': tracer.count,
+        'instructions_per_second': tracer.count / vm_time,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                      stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def run_all(names=None, repeat=3, scale=1.0):
+    results = []
+    for name, n, test_n, source in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results.append(run_benchmark(name, max(1, int(n * scale)), source,
+                                     repeat))
+    return {
+        'python': platform.python_version(),
+        'revision': git_revision(),
+        'benchmarks': results,
+    }
+
+
+def print_report(report, baseline=None, stream=None):
+    stream = stream or sys.stdout
+    previous = {}
+    if baseline:
+        previous = dict((r['name'], r) for r in baseline['benchmarks'])
+    stream.write("%-16s %9s %9s %9s %12s" % ("benchmark", "vm (s)", "py (s)",
+                                            "slowdown", "instr/s"))
+    if previous:
+        stream.write("  %9s" % "vs base")
+    stream.write("\n")
+    for r in report['benchmarks']:
+        stream.write("%-16s %9.4f %9.4f %8.1fx %12.0f" % (
+            r['name'], r['vm_time'], r['py_time'], r['slowdown'],
+            r['instructions_per_second']))
+        base = previous.get(r['name'])
+        if base:
+            stream.write("  %8.2fx" % (r['slowdown'] / base['slowdown']))
+        stream.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="take the best of this many runs")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply every workload size by this")
+    parser.add_argument("-o", "--output", help="save the results as JSON")
+    parser.add_argument("-c", "--compare", help="JSON results to compare with")
+    args = parser.parse_args(argv)
+
+    report = run_all(args.names, args.repeat, args.scale)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
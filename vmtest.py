@@ -15,6 +15,10 @@ from vm import VirtualMachine, VirtualMachineError
 CAPTURE_STDOUT = ('-s' not in sys.argv)
 CAPTURE_EXCEPTION = 1
 
+# for guest code written in one version's syntax or semantics
+py2_only = unittest.skipUnless(six.PY2, "Python 2 only")
+py3_only = unittest.skipUnless(six.PY3, "Python 3 only")
+
 
 def dis_code(code):
     for const in code.co_consts:
@@ -26,6 +30,58 @@ def dis_code(code):
     dis.dis(code)
 
 
+def run_in_vm(code, vm=None, capture=True, stdout=None):
+    """Run `code` with the VM, returning (value, exception, stdout).
+
+    With `capture`, the guest's output is collected in `stdout` (a fresh
+    StringIO by default), which keeps what was written even when the VM
+    raises.
+
+    """
+    real_stdout = sys.stdout
+
+    vm_stdout = stdout if stdout is not None else six.StringIO()
+    if capture:             
+        sys.stdout = vm_stdout
+    if vm is None:
+        vm = VirtualMachine()
+
+    vm_value = vm_exc = None
+    try:
+        vm_value = vm.run_code(code)
+    except VirtualMachineError:   
+        raise
+    except AssertionError:             
+        raise
+    except Exception as e:
+        if not CAPTURE_EXCEPTION:       
+            raise
+        vm_exc = e
+        sys.stderr.write("cat a exception in myvm")
+    finally:
+        sys.stdout = real_stdout
+    return vm_value, vm_exc, vm_stdout.getvalue()
+
+
+def run_in_python(code):
+    """Run `code` with CPython, returning (value, exception, stdout)."""
+    real_stdout = sys.stdout
+    py_stdout = six.StringIO()
+    sys.stdout = py_stdout
+
+    py_value = py_exc = None
+    globs = {}
+    try:
+        py_value = eval(code, globs, globs)
+    except AssertionError:            
+        raise
+    except Exception as e:
+        py_exc = e
+    finally:
+        sys.stdout = real_stdout
+    return py_value, py_exc, py_stdout.getvalue()
+
+
 class VmTestCase(unittest.TestCase):
 
     def assert_ok(self, code, raises=None):
@@ -35,46 +91,19 @@ class VmTestCase(unittest.TestCase):
 
 
         # 使用myvm解释器运行
-        real_stdout = sys.stdout
-
-        vm_stdout = six.StringIO()
-        if CAPTURE_STDOUT:             
-            sys.stdout = vm_stdout
-        vm = VirtualMachine()
-
-        vm_value = vm_exc = None
+        captured = six.StringIO()
         try:
-            vm_value = vm.run_code(code)
-        except VirtualMachineError:   
-            raise
-        except AssertionError:             
-            raise
-        except Exception as e:
-            if not CAPTURE_EXCEPTION:       
-                raise
-            vm_exc = e
-            sys.stderr.write("cat a exception in myvm")
+            vm_value, vm_exc, vm_stdout = run_in_vm(code, None, CAPTURE_STDOUT,
+                                                    captured)
         finally:
-            real_stdout.write("-- stdout ----------\n")
-            real_stdout.write(vm_stdout.getvalue())
+            sys.stdout.write("-- stdout ----------\n")
+            sys.stdout.write(captured.getvalue())
 
         # 使用CPython解释器运行
-        py_stdout = six.StringIO()
-        sys.stdout = py_stdout
-
-        py_value = py_exc = None
-        globs = {}
-        try:
-            py_value = eval(code, globs, globs)
-        except AssertionError:            
-            raise
-        except Exception as e:
-            py_exc = e
-
-        sys.stdout = real_stdout
+        py_value, py_exc, py_stdout = run_in_python(code)
 
         self.assert_same_exception(vm_exc, py_exc)
-        self.assertEqual(vm_stdout.getvalue(), py_stdout.getvalue())
+        self.assertEqual(vm_stdout, py_stdout)
         self.assertEqual(vm_value, py_value)
 
 